@@ -21,8 +21,6 @@ import click
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import download as gd # GEE Data Download
 
-gd.authenticate()
-
 @click.command()
 @click.option("--ci",          "-i", default=1, type=int, help="The core's id")
 @click.option("--cn",          "-n", default=2, type=int, help="The number of cores")
@@ -31,8 +29,26 @@ gd.authenticate()
 @click.option("--bands",       "-b", default="B2,B3,B4,B8A,B11,B12,Fmask", type=str, help="The bands of the data; if not specified, all bands will be downloaded")
 @click.option("--date",        "-d", default="20130411-20241231", type=str, help="The date range of the data, format: yyyymmdd(start)-yyyymmdd(end), like 20010101-20011231")
 @click.option("--extent",      "-e", default="[-76.6684662 ,  38.82467197, -76.42889892,  38.98579013]", type=str, help="The extent of the data, format: minLon,minLat,maxLon,maxLat")
+@click.option("--multiband",   "-m", is_flag=True, default=False, help="Download all missing bands of an image with a single request")
+@click.option("--workers",     "-w", default=1, type=int, help="The number of threads downloading within the core")
+@click.option("--inmemory",    "-r", is_flag=True, default=False, help="Decode and warp the downloaded bands in memory, writing each band to disk once")
+@click.option("--catalog",     "-c", is_flag=True, default=False, help="Cache the list of scenes under the destination and only query new acquisitions")
+@click.option("--queue",       "-q", is_flag=True, default=False, help="Claim the images from a queue shared by the cores, instead of splitting them by ci and cn")
+@click.option("--run-id",      "-u", default="", envvar="SLURM_ARRAY_JOB_ID", type=str, help="The identifier shared by the cores of a run, by default the SLURM array job ID; required with a queue")
+@click.option("--local-reference", "-f", is_flag=True, default=False, help="Build the reference layer from the extent locally, instead of downloading it")
+@click.option("--retries",     "-t", default=5, type=int, help="The maximum number of retries of a band failing with a transient error")
+@click.option("--ledger",      "-g", is_flag=True, default=False, help="Record the completed bands in a ledger under the destination and resume from it")
+@click.option("--datacube",    "-x", is_flag=True, default=False, help="Write the bands into a Zarr datacube under the destination, instead of one GeoTIFF per band")
+@click.option("--tile-size",   "-z", default=2048, type=int, help="The maximum rows and columns of a request; larger extents are downloaded as tiles")
+@click.option("--transport",   "-y", default="download", type=click.Choice(["download", "pixels"]), help="Transfer GeoTIFFs (download) or raw arrays on the reference grid (pixels)")
+@click.option("--min-clear",   "-a", default=0.0, type=float, help="The minimum clear fraction of the ROI of a scene to download it, from 0 to 1")
+@click.option("--max-cloud",   "-k", default=100.0, type=float, help="The maximum cloud coverage of the tile of a scene to download it, in percent")
+@click.option("--mosaic",      "-o", is_flag=True, default=False, help="Composite the scenes of the same date into one image per band")
+@click.option("--output-format", "-j", default="gtiff", type=click.Choice(["gtiff", "deflate", "zstd", "cog"]), help="The format of the band images")
+@click.option("--metrics",     "-v", is_flag=True, default=False, help="Record the timing and the progress of the task as JSON lines under the destination")
+@click.option("--checksum",    "-C", is_flag=True, default=False, help="Also record the md5 checksum of each band in the ledger, reading each band back once written")
 @click.option("--destination", "-l", default="/gpfs/sharedfs1/zhulab/Shi/ProjectSythetic/Test/SERC", type=str, help="The filepath of the data's location")
-def main(ci, cn, product, sensor, bands, date, extent, destination):
+def main(ci, cn, product, sensor, bands, date, extent, multiband, workers, inmemory, catalog, queue, run_id, local_reference, retries, ledger, datacube, tile_size, transport, min_clear, max_cloud, mosaic, output_format, metrics, checksum, destination):
     """
     Main function to download satellite data based on the specified parameters.
     Parameters:
@@ -42,6 +58,24 @@ def main(ci, cn, product, sensor, bands, date, extent, destination):
     bands (str): Comma-separated list of bands to download. If empty, all bands will be downloaded.
     date (str): Date for the data to be downloaded.
     extent (list): Spatial extent for the data download in the format [min_lon, min_lat, max_lon, max_lat].
+    multiband (bool): Whether to download all missing bands of an image with a single request.
+    workers (int): Number of threads downloading and warping the bands within the core.
+    inmemory (bool): Whether to decode and warp the downloaded bands in memory, writing each band to disk once.
+    catalog (bool): Whether to cache the list of scenes under the destination and only query new acquisitions.
+    queue (bool): Whether the cores claim the images from a shared queue instead of splitting them by ci and cn.
+    run_id (str): Identifier shared by the cores of a run, to separate its queue from the previous runs.
+    local_reference (bool): Whether to build the reference layer from the extent locally, instead of downloading it.
+    retries (int): Maximum number of retries of a band failing with a transient error, e.g., a 429 or 5xx response.
+    ledger (bool): Whether to record the completed bands in a ledger under the destination and resume from it.
+    datacube (bool): Whether to write the bands into a Zarr datacube under the destination, instead of one GeoTIFF per band.
+    tile_size (int): Maximum rows and columns of a request; larger extents are downloaded as tiles of the reference grid.
+    transport (str): Transfer GeoTIFFs from getDownloadUrl (download), or raw arrays from computePixels (pixels).
+    min_clear (float): Minimum fraction of the ROI observed clear by a scene, screened on the server before downloading.
+    max_cloud (float): Maximum cloud coverage of the tile of a scene, in percent.
+    mosaic (bool): Whether to composite the scenes of the same date, i.e., neighboring MGRS tiles, into one image per band.
+    output_format (str): Format of the band images, gtiff, deflate or zstd (tiled and compressed), or cog (Cloud-Optimized GeoTIFF).
+    metrics (bool): Whether to record the stage durations, bytes, retries and progress in metrics/<sensor>_<ci>_<cn>.jsonl under the destination.
+    checksum (bool): Whether to also record the md5 checksum of each band in the ledger, which reads each band back once written.
     destination (str): Path to the directory where the downloaded data will be saved.
     Raises:
     ValueError: If an invalid product name is provided.
@@ -51,6 +85,8 @@ def main(ci, cn, product, sensor, bands, date, extent, destination):
         bands = [band.strip() for band in bands.split(',')]
     # compare the product name to determine which download function to call
     if product.upper() == "HLS":
+        # initialize gee only when a download is run, not on --help or an invalid option
+        gd.authenticate()
         gd.hls(destination,
                date,
                extent,
@@ -58,6 +94,24 @@ def main(ci, cn, product, sensor, bands, date, extent, destination):
                bands = bands,
                ci = ci,
                cn = cn, # set up the parallelism
+               multiband = multiband,
+               workers = workers,
+               inmemory = inmemory,
+               catalog = catalog,
+               queue = queue,
+               run_id = run_id,
+               local_reference = local_reference,
+               retries = retries,
+               ledger = ledger,
+               datacube = datacube,
+               tile_size = tile_size,
+               transport = transport,
+               min_clear = min_clear,
+               max_cloud = max_cloud,
+               mosaic = mosaic,
+               output_format = output_format,
+               metrics = metrics,
+               checksum = checksum,
                )
     else:
         raise ValueError("Invalid product name. Please choose from: HLS")
@@ -0,0 +1,43 @@
+'''
+A command-line interface (CLI) to download the jobs of a manifest, e.g., several sites and sensors, in one process.
+
+The authentication, the http session and the pool of workers are shared by all jobs, and the tasks of the jobs are interleaved,
+so that a job does not have to wait for the previous one to finish. See download.load_manifest for the format of the manifest,
+and job/manifest.yaml for an example.
+'''
+
+import os
+import sys
+import click
+# Add the parent directory to this package to the system path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import download as gd # GEE Data Download
+
+@click.command()
+@click.option("--manifest",    "-m", required=True, type=str, help="The filepath of the manifest, in JSON or YAML")
+@click.option("--ci",          "-i", default=1, type=int, help="The core's id")
+@click.option("--cn",          "-n", default=1, type=int, help="The number of cores")
+@click.option("--workers",     "-w", default=1, type=int, help="The number of threads downloading within the core")
+@click.option("--retries",     "-t", default=5, type=int, help="The maximum number of retries of a task failing with a transient error")
+@click.option("--run-id",      "-u", default="", envvar="SLURM_ARRAY_JOB_ID", type=str, help="The identifier shared by the cores of a run, by default the SLURM array job ID; required with a queue")
+def main(manifest, ci, cn, workers, retries, run_id):
+    """
+    Main function to download the jobs of a manifest in one process.
+    Parameters:
+    manifest (str): Path to the manifest of the jobs.
+    ci (int): Number of concurrent instances for parallel processing.
+    cn (int): Number of concurrent nodes for parallel processing.
+    workers (int): Number of threads downloading and warping the bands within the core.
+    retries (int): Maximum number of retries of a task failing with a transient error, e.g., a 429 or 5xx response.
+    run_id (str): Identifier shared by the cores of a run, to separate its queue from the previous runs.
+    """
+
+    jobs = gd.load_manifest(manifest)
+    for job in jobs:
+        # the core's id and number apply to every job
+        job.update(ci = ci, cn = cn, run_id = run_id)
+    gd.authenticate()
+    gd.hls_batch(jobs, workers = workers, retries = retries)
+
+if __name__ == "__main__":
+    main()
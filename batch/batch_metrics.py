@@ -0,0 +1,44 @@
+'''
+A command-line interface (CLI) to merge the metrics recorded by all cores of a run, i.e., the files under <destination>/metrics,
+and to summarize where the time goes: the duration of each stage, the bytes transferred, the retries and the throughput of each core.
+'''
+
+import os
+import sys
+import json
+import click
+# Add the parent directory to this package to the system path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import download as gd # GEE Data Download
+
+@click.command()
+@click.option("--destination", "-l", required=True, type=str, help="The filepath of the data's location, which has the metrics folder")
+@click.option("--json-output", "-j", is_flag=True, default=False, help="Print the aggregated metrics as JSON")
+def main(destination, json_output):
+    """
+    Main function to summarize the metrics of a run.
+    Parameters:
+    destination (str): Path to the directory where the data of the run is saved.
+    json_output (bool): Whether to print the aggregated metrics as JSON, instead of tables.
+    """
+
+    summary = gd.aggregate_metrics(os.path.join(destination, "metrics"))
+    if json_output:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f"{'stage':<10} {'count':>8} {'total (s)':>11} {'mean (s)':>9} {'p95 (s)':>9} {'MB':>10}")
+    for stage, values in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+        print(
+            f"{stage:<10} {values['count']:>8} {values['total']:>11.1f} {values['mean']:>9.3f} "
+            f"{values['p95']:>9.3f} {values['bytes'] / 1e6:>10.1f}"
+        )
+    print()
+    print(f"{'task':<40} {'images':>8} {'elapsed (s)':>12} {'images/min':>11}")
+    for task, values in sorted(summary["tasks"].items()):
+        print(f"{task:<40} {values['images']:>8} {values['elapsed']:>12.0f} {values['rate']:>11.2f}")
+    print()
+    print(f"images: {summary['images']}, retries: {summary['retries']}")
+
+if __name__ == "__main__":
+    main()
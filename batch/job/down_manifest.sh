@@ -0,0 +1,24 @@
+#!/bin/bash
+#SBATCH -J down_gee
+#SBATCH --partition=priority
+#SBATCH --account=zhz18039
+#SBATCH --nodes 1
+#SBATCH --ntasks 1
+#SBATCH --cpus-per-task 4
+#SBATCH --array 1-20
+#SBATCH --mem-per-cpu=4G
+#SBATCH -o log/%x-out-%A_%4a.out
+#SBATCH -e log/%x-err-%A_%4a.err
+
+
+. "/home/shq19004/miniconda3/etc/profile.d/conda.sh"  # startup conda
+conda activate nightlight  # activate the conda environment
+
+echo $SLURMD_NODENAME # display the node name
+cd ../
+
+# all sites and sensors of the manifest are downloaded in one process per task
+python batch_manifest.py --ci=$SLURM_ARRAY_TASK_ID --cn=$SLURM_ARRAY_TASK_MAX --workers=8 --manifest=job/manifest.yaml
+
+echo 'Finished!'
+exit
@@ -0,0 +1,357 @@
+'''
+Description:
+Benchmark of hls() end to end, without GEE: a mock of the ee calls used by the package serves synthetic HLS-like
+GeoTIFFs from a local HTTP server, with a configurable size, latency and error rate. It reports the wall time,
+the time spent in each stage (getInfo, URL generation, transfer, read_image, warp_image, save_image),
+the scenes per second and the peak RSS, so that a change can be compared before it reaches the cluster.
+
+Usage:
+python benchmark/benchmark_hls.py --scenes 20 --size 1000 --workers 4 --latency 0.05 --error-rate 0.02
+python benchmark/benchmark_hls.py --scenes 20 --size 1000 --workers 4 --catalog
+'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import zipfile
+import zlib
+import resource
+import tempfile
+import threading
+import contextlib
+import io
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import click
+import numpy as np
+import rasterio
+from rasterio import warp
+from rasterio.io import MemoryFile
+import ee
+
+# Add the parent directory to this package to the system path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import download as gd # GEE Data Download
+import download.download as gd_download
+
+MOCK_CRS = "EPSG:32618"  # the UTM zone of the synthetic scenes, i.e., T18SUH
+MOCK_ORIGIN = (300000.0, 4300000.0)  # the upper left corner of the synthetic ROI in the UTM zone
+
+
+class StageTimer:
+    """
+    Accumulates the durations and the calls of the stages, over all threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.calls = {}
+
+    def add(self, stage, duration):
+        with self.lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + duration
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+
+class MockServer:
+    """
+    Serves the synthetic GeoTIFFs of the download urls from a local HTTP server, with a latency and an error rate.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.downloads = {}  # the parameters of each download url
+        self.images = {}  # the encoded GeoTIFFs of each grid and band, as every scene shares the grid
+        self.errors = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(server.latency)
+                with server.lock:
+                    failed = server.rng.random() < server.error_rate
+                    server.errors += failed
+                    params = server.downloads.get(self.path.lstrip("/"))
+                if failed or params is None:
+                    self.send_response(429 if failed else 404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                content = server.encode_download(params)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def register(self, params):
+        with self.lock:
+            token = f"download/{len(self.downloads):09d}"
+            self.downloads[token] = params
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/{token}"
+
+    def encode_band(self, grid, band):
+        # encode the band once per grid, as real responses of the same grid have about the same size
+        crs, transform, width, height = grid
+        key = (grid, band)
+        with self.lock:
+            if key in self.images:
+                return self.images[key]
+        rng = np.random.default_rng(zlib.crc32(repr(key).encode()))
+        if band == "Fmask":
+            data = rng.choice(np.array([0, 2, 8, 32, 64], dtype=np.uint8), size=(height, width))
+        else:
+            data = rng.integers(0, 10000, size=(height, width), dtype=np.int16)
+        profile = {
+            "driver": "GTiff",
+            "dtype": data.dtype.name,
+            "nodata": None,
+            "count": 1,
+            "width": width,
+            "height": height,
+            "crs": crs,
+            "transform": rasterio.Affine(*transform),
+        }
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as dst:
+                dst.write(data, 1)
+            content = memfile.read()
+        with self.lock:
+            self.images[key] = content
+        return content
+
+    def encode_download(self, params):
+        grid = get_download_grid(params)
+        if params["format"] == "GEO_TIFF":
+            return self.encode_band(grid, params["bands"][0])
+        # one GeoTIFF per band in a zip file, named as <name>.<band>.tif
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+            for band in params["bands"]:
+                zf.writestr(f"{params['name']}.{band}.tif", self.encode_band(grid, band))
+        return buffer.getvalue()
+
+
+def get_download_grid(params):
+    """
+    Gets the grid of a download as GEE makes it, i.e., the exact grid if given, or the region snapped to the pixels of the image.
+    Args:
+        params (dict): The parameters of the download, with the crs and the transform of the image.
+    Returns:
+        tuple: The crs, the transform as a tuple, the width and the height.
+    """
+
+    if "dimensions" in params:
+        width, height = params["dimensions"]
+        return params["crs"], tuple(params["crs_transform"]), width, height
+    crs = params["image_crs"] or MOCK_CRS
+    scale = params["scale"]
+    x_origin, y_origin = (params["image_transform"][2], params["image_transform"][5]) if params["image_transform"] else (0.0, 0.0)
+    left, bottom, right, top = warp.transform_bounds("EPSG:4326", crs, *params["region"].bounds)
+    left = x_origin + np.floor((left - x_origin) / scale) * scale
+    top = y_origin + np.ceil((top - y_origin) / scale) * scale
+    width = int(np.ceil((right - left) / scale))
+    height = int(np.ceil((top - bottom) / scale))
+    return crs, (scale, 0.0, float(left), 0.0, -scale, float(top)), width, height
+
+
+class MockGeometry:
+    def __init__(self, minx, miny, maxx, maxy):
+        self.bounds = (minx, miny, maxx, maxy)
+
+    def toGeoJSON(self):
+        minx, miny, maxx, maxy = self.bounds
+        return {"type": "Polygon", "coordinates": [[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]]}
+
+
+class MockImage:
+    def __init__(self, address, crs=None, transform=None):
+        self.address = address
+        self.crs = crs
+        self.transform = transform
+
+    def reproject(self, crs=None, crsTransform=None):
+        return MockImage(self.address, crs, crsTransform)
+
+    def select(self, *args):
+        return self
+
+    def getDownloadUrl(self, params):
+        params = dict(params, image_crs=self.crs, image_transform=self.transform)
+        return MOCK["timer"].wrap("url", MOCK["url"])(params)
+
+
+class MockFeatures:
+    def __init__(self, scenes):
+        self.scenes = scenes
+
+    def getInfo(self):
+        def get_info():
+            time.sleep(MOCK["rpc_latency"])
+            return {"features": [{"properties": {"index": scene["system:index"], "time_start": scene["system:time_start"], "CLOUD_COVERAGE": scene["CLOUD_COVERAGE"]}} for scene in self.scenes]}
+        return MOCK["timer"].wrap("getInfo", get_info)()
+
+
+def to_millis(date):
+    """
+    Converts a date of filterDate, i.e., 'YYYY-MM-DD' or milliseconds since the epoch, to milliseconds since the epoch.
+    """
+
+    if isinstance(date, str):
+        return int((time.mktime(time.strptime(date, "%Y-%m-%d")) - time.timezone) * 1000)
+    return int(date)
+
+
+class MockImageCollection:
+    def __init__(self, address, time_start=None, time_end=None):
+        self.address = address
+        self.time_start, self.time_end = time_start, time_end
+
+    def filterDate(self, date_start, date_end):
+        # a new collection, within the dates of this one, as ee does
+        time_start, time_end = to_millis(date_start), to_millis(date_end)
+        if self.time_start is not None:
+            time_start, time_end = max(time_start, self.time_start), min(time_end, self.time_end)
+        return MockImageCollection(self.address, time_start, time_end)
+
+    def filterBounds(self, roi):
+        return self
+
+    def map(self, func):
+        return MockFeatures([
+            scene for scene in MOCK["scenes"]
+            if self.time_start is None or self.time_start <= scene["system:time_start"] < self.time_end
+        ])
+
+
+MOCK = {}  # the state of the mock, shared by the mock classes
+
+
+def install_mock(server, timer, scenes, rpc_latency):
+    """
+    Replaces the ee calls used by the package with the mock, and wraps the stages of the download with the timer.
+    """
+
+    def get_url(params):
+        time.sleep(rpc_latency)
+        return server.register(params)
+
+    MOCK.update({"url": get_url, "timer": timer, "scenes": scenes, "rpc_latency": rpc_latency})
+    ee.Image = MockImage
+    ee.ImageCollection = MockImageCollection
+    ee.Geometry.BBox = MockGeometry
+    for stage, name in [
+        ("transfer", "stream_to_file"),
+        ("transfer", "stream_to_memory"),
+        ("extract", "extract_zipped_bands"),
+        ("read_image", "read_image"),
+        ("read_image", "read_zipped_images"),
+        ("warp_image", "warp_image"),
+        ("save_image", "save_image"),
+    ]:
+        setattr(gd_download, name, timer.wrap(stage, getattr(gd_download, name)))
+
+
+def create_scenes(number, date_start="2020-01-01"):
+    """
+    Creates the synthetic scenes, one every 8 days as Landsat 8 and 9 together.
+    """
+
+    time_start = time.mktime(time.strptime(date_start, "%Y-%m-%d")) - time.timezone
+    scenes = []
+    for i in range(number):
+        acquired = time.gmtime(time_start + i * 8 * 86400 + 15.5 * 3600)
+        scenes.append({
+            "system:index": time.strftime("T18SUH_%Y%m%dT153000", acquired),
+            "system:time_start": int((time_start + i * 8 * 86400 + 15.5 * 3600) * 1000),
+            "CLOUD_COVERAGE": 0,
+        })
+    return scenes
+
+
+@click.command()
+@click.option("--scenes",      "-n", default=20, type=int, help="The number of synthetic scenes")
+@click.option("--size",        "-s", default=1000, type=int, help="The rows and columns of the ROI at 30 m")
+@click.option("--bands",       "-b", default="B2,B3,B4,B5,Fmask", type=str, help="The bands to download")
+@click.option("--workers",     "-w", default=4, type=int, help="The number of threads")
+@click.option("--latency",     "-l", default=0.05, type=float, help="The seconds before each http response")
+@click.option("--rpc-latency", "-p", default=0.1, type=float, help="The seconds of each mocked gee call, i.e., getInfo and getDownloadUrl")
+@click.option("--error-rate",  "-e", default=0.0, type=float, help="The fraction of http responses failing with 429")
+@click.option("--multiband",   "-m", is_flag=True, default=False, help="Download all bands of a scene with a single request")
+@click.option("--inmemory",    "-r", is_flag=True, default=False, help="Decode the downloads in memory")
+@click.option("--output-format", "-f", default="gtiff", type=str, help="The format of the band images")
+@click.option("--seed",        "-d", default=0, type=int, help="The seed of the errors, for reproducible runs")
+@click.option("--catalog",     "-c", is_flag=True, default=False, help="Cache the scenes in a catalog, and run again to time the resume of a completed download")
+def main(scenes, size, bands, workers, latency, rpc_latency, error_rate, multiband, inmemory, output_format, seed, catalog):
+    # the roi of size x size pixels in the utm zone, in longitude and latitude
+    x_origin, y_origin = MOCK_ORIGIN
+    minx, miny, maxx, maxy = warp.transform_bounds(MOCK_CRS, "EPSG:4326", x_origin, y_origin - size * 30, x_origin + size * 30, y_origin)
+    extent = json.dumps([minx, miny, maxx, maxy])
+    date = "20200101-" + time.strftime("%Y%m%d", time.gmtime(time.time()))
+
+    timer = StageTimer()
+    destination = tempfile.mkdtemp()
+    with MockServer(latency=latency, error_rate=error_rate, seed=seed) as server:
+        install_mock(server, timer, create_scenes(scenes), rpc_latency)
+        elapsed = []
+        # the second run resumes the completed download, with the scenes read from the catalog
+        for _ in range(2 if catalog else 1):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                gd.hls(
+                    destination,
+                    date,
+                    extent,
+                    bands.split(","),
+                    workers=workers,
+                    multiband=multiband,
+                    inmemory=inmemory,
+                    catalog=catalog,
+                    output_format=output_format,
+                )
+            elapsed.append(time.perf_counter() - start)
+        errors = server.errors
+    shutil.rmtree(destination)
+
+    print(f"scenes: {scenes}, size: {size}x{size}, bands: {bands}, workers: {workers}, multiband: {multiband}, inmemory: {inmemory}, catalog: {catalog}")
+    print(f"wall time: {elapsed[0]:.2f} s, scenes/sec: {scenes / elapsed[0]:.2f}, http errors: {errors}")
+    if catalog:
+        print(f"resume wall time: {elapsed[1]:.2f} s")
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    print(f"{'stage':<12} {'calls':>8} {'total (s)':>10} {'mean (ms)':>10}")
+    for stage in ["getInfo", "url", "transfer", "extract", "read_image", "warp_image", "save_image"]:
+        if stage in timer.calls:
+            print(f"{stage:<12} {timer.calls[stage]:>8} {timer.durations[stage]:>10.3f} {timer.durations[stage] / timer.calls[stage] * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+'''
+Description:
+Benchmark of the startup cost of a task, i.e., the time of a fresh python process to import the package, to load the
+download functions, and to parse an inline ROI, along with the heavy modules each step imports.
+Each step runs in new processes, as the array tasks do, and is timed within the process, i.e., without the start of python.
+To compare with another version, point --root to its checkout, e.g., made by git worktree.
+
+Usage:
+python benchmark/benchmark_import.py --repeats 10
+python benchmark/benchmark_import.py --repeats 10 --root ../geeget-main
+'''
+
+import os
+import sys
+import json
+import subprocess
+import statistics
+import click
+
+HEAVY_MODULES = ["ee", "numpy", "rasterio", "requests", "geopandas", "shapely", "pandas", "zarr"]
+
+# the code run by each step, which prints the heavy modules it has imported
+STEPS = {
+    "import download": "import download",
+    "load hls": "import download; download.hls",
+    "parse roi": (
+        "from download.utils import parse_gee_roi; import ee; ee.Geometry.BBox = lambda *bounds: bounds; "
+        "parse_gee_roi('[-76.6684662, 38.82467197, -76.42889892, 38.98579013]')"
+    ),
+}
+REPORT = "; import sys, json; print(json.dumps([m for m in {modules} if m in sys.modules]))"
+
+
+def time_process(code, root):
+    """
+    Runs the code in a fresh python process with the package of the root, and returns the lines of the output,
+    the last of which is the time of the code.
+    """
+
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    code = "import time; _start = time.perf_counter(); " + code + "; print(time.perf_counter() - _start)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, env=env, capture_output=True, text=True, check=True).stdout
+    return output.splitlines()
+
+
+@click.command()
+@click.option("--repeats", "-r", default=10, type=int, help="The processes run per step, of which the median is reported")
+@click.option("--root",    "-p", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."), type=str, help="The directory containing the package to benchmark")
+def main(repeats, root):
+    print(f"{'step':<16} {'median (s)':>10} {'min (s)':>8}  heavy modules imported")
+    for step, code in STEPS.items():
+        times = []
+        for _ in range(repeats):
+            lines = time_process(code + REPORT.format(modules=HEAVY_MODULES), os.path.abspath(root))
+            modules, elapsed = json.loads(lines[-2]), float(lines[-1])
+            times.append(elapsed)
+        print(f"{step:<16} {statistics.median(times):>10.3f} {min(times):>8.3f}  {', '.join(modules) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+'''
+Description:
+Benchmark of the output formats of the band images, i.e., the write time, the file size and the read time,
+for synthetic bands like HLS: reflectance, Fmask and angles.
+
+Usage:
+python benchmark/benchmark_output_format.py --size 3660 --repeats 3
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import click
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# Add the parent directory to this package to the system path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from download.utils import get_output_profile, save_image
+from download.constants import OUTPUT_FORMATS
+
+
+def synthesize_band(band, size, rng):
+    """
+    Synthesizes a band like HLS, i.e., spatially correlated reflectance, categorical Fmask bits, or smooth angles.
+    Args:
+        band (str): The name of the band, 'reflectance', 'Fmask' or 'angle'.
+        size (int): The number of rows and columns.
+        rng (numpy.random.Generator): The random generator.
+    Returns:
+        numpy.ndarray: The band data.
+    """
+
+    if band == "angle":
+        rows, cols = np.mgrid[0:size, 0:size]
+        return (3000 + rows * 0.5 + cols * 0.2).astype(np.int16)
+    # smooth fields as land patches, by upsampling a coarse random field
+    coarse = rng.random((size // 32 + 1, size // 32 + 1))
+    field = np.kron(coarse, np.ones((32, 32)))[:size, :size]
+    if band == "Fmask":
+        # clear land, water, cloud and cloud shadow
+        return np.choose((field * 4).astype(int), [0, 32, 2, 8]).astype(np.uint8)
+    return (field * 3000 + rng.normal(0, 50, (size, size))).astype(np.int16)
+
+
+@click.command()
+@click.option("--size", "-s", default=3660, type=int, help="The rows and columns of the bands, 3660 for a full HLS tile")
+@click.option("--repeats", "-r", default=3, type=int, help="The repeats of each measurement, of which the best is reported")
+@click.option("--formats", "-f", default=",".join(OUTPUT_FORMATS), type=str, help="The output formats to compare, separated by commas")
+def main(size, repeats, formats):
+    rng = np.random.default_rng(0)
+    profile = {
+        "driver": "GTiff",
+        "dtype": "int16",
+        "nodata": None,
+        "count": 1,
+        "width": size,
+        "height": size,
+        "crs": CRS.from_epsg(32618),
+        "transform": from_origin(300000, 4300000, 30, 30),
+    }
+    bands = {band: synthesize_band(band, size, rng) for band in ["reflectance", "Fmask", "angle"]}
+    window = Window(size // 2, size // 2, min(512, size // 2), min(512, size // 2))
+
+    folderpath = tempfile.mkdtemp()
+    print(f"{'format':<8} {'band':<12} {'write (s)':>10} {'size (MB)':>10} {'read (s)':>10} {'window (ms)':>12}")
+    try:
+        for output_format in formats.split(","):
+            outprofile = get_output_profile(profile, output_format)
+            for band, data in bands.items():
+                filepath = os.path.join(folderpath, f"{output_format}_{band}.tif")
+                desprofile = dict(outprofile, dtype=data.dtype.name)
+                times_write, times_read, times_window = [], [], []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    save_image(filepath, data, desprofile)
+                    times_write.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    with rasterio.open(filepath) as src:
+                        src.read(1)
+                    times_read.append(time.perf_counter() - start)
+                    # a window as read by the downstream time series
+                    start = time.perf_counter()
+                    with rasterio.open(filepath) as src:
+                        src.read(1, window=window)
+                    times_window.append(time.perf_counter() - start)
+                print(
+                    f"{output_format:<8} {band:<12} {min(times_write):>10.3f} {os.path.getsize(filepath) / 1e6:>10.2f} "
+                    f"{min(times_read):>10.3f} {min(times_window) * 1000:>12.2f}"
+                )
+    finally:
+        shutil.rmtree(folderpath)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,36 @@ Last Edit Time: 2025-01-09 16:15:00
 Description:
 This file initializes the Google Earth Engine authentication package.
 It exposes the `authenticate` function for easy access when the package is imported.
+The functions are loaded lazily, on first access.
 '''
 
-from .auth import authenticate
-from .download import hls
+# the functions are imported on first use, so that importing the package does not pay for gee, rasterio and the others
+_exports = {
+    'authenticate': '.auth',
+    'hls': '.download',
+    'hls_batch': '.download',
+    'hls_points': '.points',
+    'load_manifest': '.manifest',
+    'aggregate_metrics': '.metrics',
+}
 
 # Explicitly define the public interface
 __all__ = [
     'authenticate',
     'hls',
-    ]  
\ No newline at end of file
+    'hls_batch',
+    'hls_points',
+    'load_manifest',
+    'aggregate_metrics',
+    ]  
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value  # the later accesses do not come here
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
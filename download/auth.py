@@ -13,7 +13,11 @@ Raises:
     ee.EEException: If the initialization fails and authentication is required.
 '''
 
-import ee
+import threading
+
+# the api is initialized once per process, and the credentials are reused by all later calls and jobs
+_initialized = False
+_initialize_lock = threading.Lock()
 
 def authenticate():
     """
@@ -22,23 +26,31 @@ def authenticate():
     If the user is already authenticated, the function initializes the API.
     If authentication is required, it prompts the user to authenticate
     and then reinitializes the API upon successful authentication.
+    Once the API is initialized, later calls in the same process return at once.
 
     Raises:
         ee.EEException: If initialization fails and authentication is required.
     """
-    try:
-        # Attempt to initialize the Earth Engine API
-        ee.Initialize()
-        print("Google Earth Engine API initialized successfully.")
-    except ee.EEException:
-        # Handle cases where authentication is required
-        print("Authentication required.")
-        print("Redirecting to authentication flow... (Use Jupyter Notebook for easier interaction)")
-        
-        # Trigger the authentication process
-        ee.Authenticate()
-        print("Authentication completed.")
-        
-        # Reinitialize the Earth Engine API after authentication
-        ee.Initialize()
-        print("Google Earth Engine API initialized successfully.")
+    global _initialized
+    import ee  # imported only when needed, as it is slow to import
+
+    with _initialize_lock:
+        if _initialized:
+            return
+        try:
+            # Attempt to initialize the Earth Engine API
+            ee.Initialize()
+            print("Google Earth Engine API initialized successfully.")
+        except ee.EEException:
+            # Handle cases where authentication is required
+            print("Authentication required.")
+            print("Redirecting to authentication flow... (Use Jupyter Notebook for easier interaction)")
+            
+            # Trigger the authentication process
+            ee.Authenticate()
+            print("Authentication completed.")
+            
+            # Reinitialize the Earth Engine API after authentication
+            ee.Initialize()
+            print("Google Earth Engine API initialized successfully.")
+        _initialized = True
@@ -0,0 +1,273 @@
+'''
+query the scenes of gee collections, with a local cache of the catalog
+'''
+
+import json
+import os
+import time
+import sqlite3
+from contextlib import closing, nullcontext
+import ee
+from .constants import CATALOG_PROPERTIES, CATALOG_REFRESH, SCREEN_BATCH_SIZE, SCREEN_FMASK_BITS, SCREEN_RESOLUTION
+from .utils import split_date_range
+from .session import call_with_retry
+from .metrics import record_stage
+from .datacube import lock_file
+
+def fetch_scenes(collection, properties=CATALOG_PROPERTIES, date_start=None, date_end=None):
+    """
+    Fetches the scene IDs and the key properties of an image collection, leaving out all other metadata.
+    Args:
+        collection (ee.ImageCollection): The filtered image collection.
+        properties (list, optional): The names of the image properties to fetch besides 'system:index' and 'system:time_start'.
+        date_start (str or int, optional): The start date of the collection, in 'YYYY-MM-DD' format or in milliseconds since the epoch.
+            With the end date, the scenes are fetched year by year, to keep each query under the 5000 elements returned by GEE.
+            Default is None to fetch all scenes at once.
+        date_end (str, optional): The end date (exclusive) of the collection, in 'YYYY-MM-DD' format. Default is None.
+    Returns:
+        list: The properties of each scene as a dictionary, sorted by the acquisition time and the scene ID.
+    """
+
+    if date_start is None or date_end is None:
+        collections = [collection]
+    else:
+        day_start = date_start if isinstance(date_start, str) else time.strftime("%Y-%m-%d", time.gmtime(date_start / 1000))
+        date_ranges = split_date_range(day_start, date_end)
+        if date_ranges:
+            # keep the exact start, e.g., the time past the last cached scene
+            date_ranges[0] = (date_start, date_ranges[0][1])
+        collections = [collection.filterDate(year_start, year_end) for year_start, year_end in date_ranges]
+
+    features = []
+    for collection_year in collections:
+        # map the images into features only holding the needed properties, so that only them are transferred
+        features_year = collection_year.map(
+            lambda image: ee.Feature(None, image.toDictionary(properties)).set(
+                "index", image.get("system:index"),
+                "time_start", image.get("system:time_start"),
+            )
+        )
+        with record_stage("getInfo"):
+            features.extend(features_year.getInfo()["features"])
+    scenes = []
+    for feature in features:
+        feature_properties = feature["properties"]
+        scene = {"system:index": feature_properties.pop("index"), "system:time_start": feature_properties.pop("time_start")}
+        scene.update({name: feature_properties.get(name) for name in properties})
+        scenes.append(scene)
+    return sorted(scenes, key=lambda scene: (scene["system:time_start"], scene["system:index"]))
+
+def query_scenes(filepath_catalog, collection_address, date_start, date_end, roi_gee, properties=CATALOG_PROPERTIES):
+    """
+    Queries the scenes of a gee collection through a local SQLite cache of the catalog.
+    The first query of a collection, date range and ROI fetches all scenes; later queries only fetch the scenes
+    acquired after the last cached one, and read the others from the cache. The parallel processes take turns, so that
+    the first one fetches the scenes, and the others read the same list from the cache within CATALOG_REFRESH seconds.
+    Args:
+        filepath_catalog (str): The path of the SQLite file of the cache, which is created if it does not exist.
+        collection_address (str): The address of the collection, e.g., 'NASA/HLS/HLSL30/v002'.
+        date_start (str): The start date, in 'YYYY-MM-DD' format.
+        date_end (str): The end date (exclusive), in 'YYYY-MM-DD' format.
+        roi_gee (ee.Geometry): The region of interest.
+        properties (list, optional): The names of the image properties to cache besides 'system:index' and 'system:time_start'.
+    Returns:
+        list: The properties of each scene as a dictionary, sorted by the acquisition time and the scene ID.
+    """
+
+    query = json.dumps([collection_address, date_start, date_end, roi_gee.toGeoJSON(), sorted(properties)], sort_keys=True)
+    # the other processes wait for the scenes fetched by the one holding the lock, instead of fetching them again
+    with lock_file(f"{filepath_catalog}.lock"), closing(sqlite3.connect(str(filepath_catalog), timeout=600)) as conn:
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, time_last INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS scenes (query TEXT, system_index TEXT, time_start INTEGER, properties TEXT, "
+                "PRIMARY KEY (query, system_index))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS refreshes (query TEXT PRIMARY KEY, time_refresh REAL)"
+            )
+        row = conn.execute("SELECT time_last FROM queries WHERE query = ?", (query,)).fetchone()
+        refresh = conn.execute("SELECT time_refresh FROM refreshes WHERE query = ?", (query,)).fetchone()
+
+        if row is None or refresh is None or time.time() - refresh[0] >= CATALOG_REFRESH:
+            # only fetch the acquisitions past the last cached one
+            date_fetch = date_start if row is None or row[0] is None else row[0] + 1
+            collection = ee.ImageCollection(collection_address).filterBounds(roi_gee)
+            scenes_new = fetch_scenes(collection, properties, date_fetch, date_end)
+
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO scenes VALUES (?, ?, ?, ?)",
+                    [
+                        (query, scene["system:index"], scene["system:time_start"],
+                         json.dumps({name: scene[name] for name in properties}))
+                        for scene in scenes_new
+                    ],
+                )
+                time_last = max([scene["system:time_start"] for scene in scenes_new], default=None)
+                conn.execute("INSERT OR IGNORE INTO queries VALUES (?, NULL)", (query,))
+                if time_last is not None:
+                    conn.execute(
+                        "UPDATE queries SET time_last = MAX(COALESCE(time_last, ?), ?) WHERE query = ?",
+                        (time_last, time_last, query),
+                    )
+                conn.execute("INSERT OR REPLACE INTO refreshes VALUES (?, ?)", (query, time.time()))
+
+        rows = conn.execute(
+            "SELECT system_index, time_start, properties FROM scenes WHERE query = ? ORDER BY time_start, system_index",
+            (query,),
+        ).fetchall()
+    scenes = []
+    for system_index, time_start, scene_properties in rows:
+        scene = {"system:index": system_index, "system:time_start": time_start}
+        scene.update(json.loads(scene_properties))
+        scenes.append(scene)
+    return scenes
+
+def group_scenes(scenes):
+    """
+    Groups the scenes acquired on the same date, i.e., the MGRS tiles of the same overpass over the ROI, to be mosaicked.
+    Args:
+        scenes (list): The properties of each scene as a dictionary, as from fetch_scenes.
+    Returns:
+        list: One scene per date, with the properties of its clearest scene, the earliest acquisition time,
+            the date as 'date' (i.e., '20200112'), and the IDs of the grouped scenes as 'scenes', ordered from the most
+            clouded to the clearest, which is on top of the mosaic.
+    """
+
+    groups = {}
+    for scene in scenes:
+        date = time.strftime("%Y%m%d", time.gmtime(scene["system:time_start"] / 1000))
+        groups.setdefault(date, []).append(scene)
+    mosaics = []
+    for date, group in groups.items():
+        group = sorted(group, key=lambda scene: -(scene.get("CLOUD_COVERAGE") or 0))
+        mosaic = dict(group[-1])
+        mosaic["system:time_start"] = min(scene["system:time_start"] for scene in group)
+        mosaic["date"] = date
+        mosaic["scenes"] = [scene["system:index"] for scene in group]
+        mosaics.append(mosaic)
+    return sorted(mosaics, key=lambda scene: (scene["system:time_start"], scene["system:index"]))
+
+def get_screening_key(scene):
+    """
+    Gets the key of a scene in the screening file, i.e., its scene ID, or the IDs of the grouped scenes of a mosaic
+    joined by '+', so that a mosaic is screened again once the scenes of its date change.
+    Args:
+        scene (dict): The properties of the scene, as from fetch_scenes, or of the mosaic, as from group_scenes.
+    Returns:
+        str: The key of the scene.
+    """
+
+    return "+".join(scene["scenes"]) if "scenes" in scene else scene["system:index"]
+
+def compute_clear_fractions(collection, scenes, roi_gee, resolution=SCREEN_RESOLUTION):
+    """
+    Computes the fraction of the ROI that is observed clear by each scene, or by each mosaic of the scenes of a date,
+    from the Fmask bits of cloud, adjacent cloud and cloud shadow, with a single server-side reduction over the whole list.
+    Args:
+        collection (ee.ImageCollection): The collection filtered by the date range and the ROI, as the scenes were fetched from.
+        scenes (list): The properties of each scene, as from fetch_scenes, or of each mosaic, as from group_scenes.
+        roi_gee (ee.Geometry): The region of interest.
+        resolution (int, optional): The resolution (in meters) of the reduction; coarse pixels are enough for a fraction.
+    Returns:
+        dict: The clear fraction of each screening key, from 0 to 1, or None if it could not be computed.
+    """
+
+    def reduce_clear(image):
+        # the pixels outside of the footprint count as not clear, so that partial scenes are scored over the whole ROI
+        clear = image.select("Fmask").bitwiseAnd(SCREEN_FMASK_BITS).eq(0).unmask(0, False)
+        fraction = clear.reduceRegion(
+            reducer=ee.Reducer.mean(), geometry=roi_gee, scale=resolution, maxPixels=1e9, bestEffort=True
+        ).get("Fmask")
+        return ee.Feature(None, {"index": image.get("system:index"), "clear": fraction})
+
+    # the scenes are looked up in the filtered collection, instead of the whole archive
+    if any("scenes" in scene for scene in scenes):
+        # each mosaic is scored as it is downloaded, i.e., with the clearest scene on top
+        images = ee.ImageCollection([
+            ee.ImageCollection([
+                ee.Image(collection.filter(ee.Filter.eq("system:index", system_index)).first())
+                for system_index in scene["scenes"]
+            ]).mosaic().set("system:index", get_screening_key(scene))
+            for scene in scenes
+        ])
+    else:
+        images = collection.filter(ee.Filter.inList("system:index", [scene["system:index"] for scene in scenes]))
+    features = images.map(reduce_clear)
+    with record_stage("screen", scenes=len(scenes)):
+        features = features.getInfo()["features"]
+    return {
+        feature["properties"]["index"]: feature["properties"].get("clear")
+        for feature in features
+    }
+
+def screen_scenes(collection, scenes, roi_gee, min_clear=0.0, max_cloud=100, filepath_screening=None, batch_size=SCREEN_BATCH_SIZE):
+    """
+    Screens the scenes before downloading, and keeps the ones with a tile-wide cloud coverage (the 'CLOUD_COVERAGE' property)
+    up to max_cloud, and a clear fraction of the ROI of at least min_clear. The clear fractions are only computed for the
+    scenes passing the cloud coverage, in batches of server-side reductions. With a screening file, the parallel processes
+    take turns, so that the first one computes the clear fractions and the others read them.
+    Args:
+        collection (ee.ImageCollection): The collection filtered by the date range and the ROI, as the scenes were fetched from.
+        scenes (list): The properties of each scene as a dictionary, as from fetch_scenes, or of each mosaic, as from group_scenes,
+            which is screened as a whole with the cloud coverage of its clearest scene.
+        roi_gee (ee.Geometry): The region of interest.
+        min_clear (float, optional): The minimum clear fraction of the ROI, from 0 to 1. Default is 0.
+        max_cloud (float, optional): The maximum cloud coverage of the tile, in percent. Default is 100.
+        filepath_screening (str, optional): The path of the JSON file recording the cloud coverages and the clear fractions of
+            the scenes, which are reused by later runs and the other parallel processes. Default is None.
+        batch_size (int, optional): The number of scenes reduced by one query.
+    Returns:
+        list: The scenes passing the screening, in the same order.
+    """
+
+    # the cloud coverage is known from the catalog, so that the clouded tiles are dropped without any reduction
+    scenes_cloud = [
+        scene for scene in scenes
+        if scene.get("CLOUD_COVERAGE") is None or scene["CLOUD_COVERAGE"] <= max_cloud
+    ]
+
+    # the other processes wait for the clear fractions computed by the one holding the lock, instead of computing them again
+    with lock_file(f"{filepath_screening}.lock") if filepath_screening is not None else nullcontext():
+        # the recorded clear fractions are only valid for the same roi
+        roi = roi_gee.toGeoJSON()
+        screening = {"roi": roi, "resolution": SCREEN_RESOLUTION, "scenes": {}}
+        if filepath_screening is not None and os.path.isfile(filepath_screening):
+            with open(filepath_screening) as f:
+                recorded = json.load(f)
+            if recorded.get("roi") == roi and recorded.get("resolution") == SCREEN_RESOLUTION:
+                screening = recorded
+
+        if min_clear > 0:
+            scenes_missing = [
+                scene for scene in scenes_cloud
+                if "clear_fraction" not in screening["scenes"].get(get_screening_key(scene), {})
+            ]
+            for start in range(0, len(scenes_missing), batch_size):
+                fractions = call_with_retry(
+                    compute_clear_fractions, collection, scenes_missing[start:start + batch_size], roi_gee
+                )
+                for scene in scenes_missing[start:start + batch_size]:
+                    key = get_screening_key(scene)
+                    screening["scenes"].setdefault(key, {})["clear_fraction"] = fractions.get(key)
+        for scene in scenes:
+            screening["scenes"].setdefault(get_screening_key(scene), {})["cloud_coverage"] = scene.get("CLOUD_COVERAGE")
+
+        if filepath_screening is not None:
+            # write to a temporary file first, so that a killed process does not leave a broken file
+            filepath_temp = f"{filepath_screening}.{os.getpid()}.part"
+            with open(filepath_temp, "w") as f:
+                json.dump(screening, f)
+            os.replace(filepath_temp, filepath_screening)
+
+    # the scenes without a clear fraction, e.g., not reduced within the limits, are kept rather than lost
+    scenes_passed = [
+        scene for scene in scenes_cloud
+        if min_clear <= 0
+        or screening["scenes"][get_screening_key(scene)].get("clear_fraction") is None
+        or screening["scenes"][get_screening_key(scene)]["clear_fraction"] >= min_clear
+    ]
+    return scenes_passed
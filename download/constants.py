@@ -4,3 +4,28 @@ GEE_HLSL30_ADDRESS = "NASA/HLS/HLSL30/v002"
 GEE_HLSS30_ADDRESS = "NASA/HLS/HLSS30/v002"
 GEE_HLSL30_BANDS   = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B9', 'B10', 'B11', 'Fmask', 'SZA', 'SAA', 'VZA', 'VAA']
 GEE_HLSS30_BANDS   = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B8', 'B8A', 'B9', 'B10', 'B11', 'B12', 'Fmask', 'SZA', 'SAA', 'VZA', 'VAA']
+GEE_HLS_NODATA     = {'default': -9999, 'Fmask': 255, 'SZA': 40000, 'SAA': 40000, 'VZA': 40000, 'VAA': 40000}  # the fill values of the masked pixels of HLS bands, within the range of their types, i.e., int16 reflectance, uint8 Fmask and uint16 angles
+CATALOG_PROPERTIES = ['CLOUD_COVERAGE']  # the image properties cached in the catalog besides the scene ID and the acquisition time
+CATALOG_REFRESH    = 3600  # seconds a query of the catalog is read from the cache only, so that the tasks of a run share one list of scenes
+SCREEN_FMASK_BITS  = 0b1110  # the Fmask bits of cloud, adjacent cloud and cloud shadow, which make a pixel not clear
+SCREEN_RESOLUTION  = 120  # meters of the pixels counted for the clear fraction of a scene
+SCREEN_BATCH_SIZE  = 500  # scenes whose clear fractions are reduced by one query
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes streamed from the http response to disk at a time
+DOWNLOAD_TILE_SIZE = 2048  # maximum rows and columns of a request, to stay under the size limit of getDownloadUrl
+DOWNLOAD_TILE_WORKERS = 4  # tiles of a band downloaded at the same time
+REQUEST_MAX_BYTES = 32 * 1024 * 1024  # bytes of the pixels of a getDownloadUrl or computePixels request, under their 48 MB limit
+DOWNLOAD_RETRIES = 5  # retries of a band failing with a transient error, e.g., a 429 or 5xx response
+GEE_RETRY_MESSAGES = ('too many', 'quota', 'rate limit', 'timed out', 'timeout', 'internal error', 'service unavailable', 'backend error')  # transient gee errors
+GEE_ELEMENTS_MESSAGE = 'accumulating over'  # the gee error of a request returning more than 5000 elements, e.g., the samples of points
+METRICS_INTERVAL = 60  # seconds between two reports of the progress of a task, i.e., the throughput and the estimated time left
+QUEUE_LEASE = 1800  # seconds an image claimed from the queue is leased to a process before others can claim it again
+# the creation options of the band images for each output format, with 'gtiff' keeping the profile of the reference layer
+OUTPUT_FORMATS = {
+    'gtiff': {},
+    'deflate': {'driver': 'GTiff', 'compress': 'deflate', 'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'num_threads': 'ALL_CPUS'},
+    'zstd': {'driver': 'GTiff', 'compress': 'zstd', 'zstd_level': 9, 'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'num_threads': 'ALL_CPUS'},
+    'cog': {'driver': 'COG', 'compress': 'deflate', 'blocksize': 512, 'overviews': 'auto', 'num_threads': 'ALL_CPUS'},
+}
+DATACUBE_TIME_CHUNK = 32  # time steps per chunk of the datacube, so that a pixel's time series is a few chunk reads
+DATACUBE_SPACE_CHUNK = 256  # rows and columns per chunk of the datacube
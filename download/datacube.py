@@ -0,0 +1,123 @@
+'''
+write the warped bands into a chunked time-series datacube (Zarr), as an alternative to one GeoTIFF per band
+'''
+
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+import numpy as np
+from .constants import DATACUBE_TIME_CHUNK, DATACUBE_SPACE_CHUNK
+
+# the POSIX locks are held per process, so the threads of a process also need to take a lock of their own
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+@contextmanager
+def lock_file(filepath_lock):
+    """
+    Holds an exclusive lock on a file, across the threads of this process and the processes sharing the file system.
+    Args:
+        filepath_lock (str): The path of the lock file, which is created if it does not exist.
+    """
+
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(filepath_lock, threading.Lock())
+    with thread_lock:
+        fd = os.open(filepath_lock, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+def open_datacube(folderpath_cube, scenes, likeprofile):
+    """
+    Creates the datacube, or extends its time axis with the scenes it does not have yet.
+    The time axis follows the order the scenes were added, and the 'scenes' attribute and the 'time' array give the
+    scene of each time step; the grid is the reference layer.
+    Args:
+        folderpath_cube (str): The path of the datacube, i.e., a Zarr group.
+        scenes (list): The scenes, each one a dictionary with 'name' and 'system:time_start'.
+        likeprofile (dict): The profile of the reference layer.
+    Returns:
+        dict: The position of each scene on the time axis by name.
+    """
+
+    import zarr  # only required for the datacube
+
+    os.makedirs(folderpath_cube, exist_ok=True)
+    with lock_file(os.path.join(folderpath_cube, '.lock')):
+        group = zarr.open_group(folderpath_cube, mode='a')
+        names = list(group.attrs.get('scenes', []))
+        times = list(group['time'][:]) if 'time' in group else []
+        scenes_new = [scene for scene in scenes if scene['name'] not in set(names)]
+        if scenes_new or 'time' not in group:
+            names += [scene['name'] for scene in scenes_new]
+            times += [scene['system:time_start'] for scene in scenes_new]
+            # the coordinates, following the conventions of xarray
+            transform = likeprofile['transform']
+            coordinates = {
+                'time': np.array(times, dtype='int64'),
+                'y': transform.f + transform.e * (np.arange(likeprofile['height']) + 0.5),
+                'x': transform.c + transform.a * (np.arange(likeprofile['width']) + 0.5),
+            }
+            for name, values in coordinates.items():
+                array = zarr.open_array(
+                    os.path.join(folderpath_cube, name), mode='a', shape=values.shape, chunks=(max(len(values), 1),), dtype=values.dtype
+                )
+                array.resize(values.shape)
+                array[:] = values
+                array.attrs['_ARRAY_DIMENSIONS'] = [name]
+            group['time'].attrs['units'] = 'milliseconds since 1970-01-01'
+            # extend the bands already in the datacube
+            for name in group.attrs.get('bands', []):
+                array = zarr.open_array(os.path.join(folderpath_cube, name), mode='a')
+                array.resize((len(names),) + array.shape[1:])
+            group.attrs.update({
+                'scenes': names,
+                'crs': likeprofile['crs'].to_wkt(),
+                'transform': list(transform)[:6],
+            })
+    return {name: position for position, name in enumerate(names)}
+
+def write_datacube(folderpath_cube, band, position, data, profile, time_chunk=DATACUBE_TIME_CHUNK, space_chunk=DATACUBE_SPACE_CHUNK):
+    """
+    Writes a warped band of a scene into the datacube. A band is created as an array of (time, y, x) on its first write,
+    chunked along time, so that the time series of a pixel is a few chunk reads. The writes to a time chunk are serialized
+    by a lock file, so that processes writing different scenes of the same chunk do not overwrite each other.
+    Args:
+        folderpath_cube (str): The path of the datacube, created by open_datacube.
+        band (str): The name of the band.
+        position (int): The position of the scene on the time axis.
+        data (numpy.ndarray): The warped band, on the grid of the datacube.
+        profile (dict): The profile of the warped band, containing the data type and nodata.
+        time_chunk (int, optional): The number of time steps per chunk, when the band is created. Default is 32.
+        space_chunk (int, optional): The number of rows and columns per chunk, when the band is created. Default is 256.
+    """
+
+    import zarr  # only required for the datacube
+
+    filepath_band = os.path.join(folderpath_cube, band)
+    # the band is only listed in the attributes of the group once it is fully created, which is checked within the lock,
+    # as the folder of the band appears before its metadata while another process is creating it
+    with lock_file(os.path.join(folderpath_cube, '.lock')):
+        group = zarr.open_group(folderpath_cube, mode='a')
+        if band not in group.attrs.get('bands', []):
+            array = zarr.open_array(
+                filepath_band,
+                mode='a',
+                shape=(len(group.attrs['scenes']),) + data.shape,
+                chunks=(time_chunk, space_chunk, space_chunk),
+                dtype=profile['dtype'],
+                fill_value=profile['nodata'] if profile['nodata'] is not None else 0,
+            )
+            array.attrs['_ARRAY_DIMENSIONS'] = ['time', 'y', 'x']
+            array.attrs['nodata'] = profile['nodata']
+            group.attrs['bands'] = group.attrs.get('bands', []) + [band]
+
+    array = zarr.open_array(filepath_band, mode='a')
+    os.makedirs(os.path.join(folderpath_cube, '.locks'), exist_ok=True)
+    with lock_file(os.path.join(folderpath_cube, '.locks', f'{band}_{position // array.chunks[0]}')):
+        array[position] = data
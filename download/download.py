@@ -3,28 +3,89 @@ download data from gee
 '''
 
 import os
+import json
 from pathlib import Path
-import requests
 import ee
+import numpy as np
+import rasterio
+from rasterio import Affine
+from rasterio.windows import Window
 from .utils import (
+    parse_hls_sensor,
     parse_gee_roi,
     parse_gee_date,
     parse_band_name,
     parse_reference_name,
     filter_missing_bands,
+    extract_zipped_bands,
+    read_zipped_images,
+    get_warp_buffer,
+    split_tiles,
+    fit_tile_size,
     get_reference_profile,
+    create_reference_profile,
+    get_roi_bounds,
+    get_utm_crs,
     warp_image,
     read_image,
     save_image,
+    get_output_profile,
+    set_predictor,
 )
+from .session import get_session, stream_to_file, stream_to_memory, call_with_retry, AdaptiveLimiter
+from .scheduler import run_bounded, interleave_tasks, claim_tasks, renew_task, complete_task, count_tasks
+from .catalog import fetch_scenes, query_scenes, screen_scenes, group_scenes
+from .ledger import describe_band, append_ledger, load_ledger
+from .datacube import open_datacube, write_datacube
+from .metrics import MetricsRecorder, record_stage, bind_scope
 from .constants import (
-    GEE_HLSL30_ADDRESS,
-    GEE_HLSS30_ADDRESS,
-    GEE_HLSL30_BANDS,
-    GEE_HLSS30_BANDS,
+    DOWNLOAD_CHUNK_SIZE,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_TILE_SIZE,
+    DOWNLOAD_TILE_WORKERS,
+    GEE_HLS_NODATA,
+    OUTPUT_FORMATS,
+    QUEUE_LEASE,
 )
 
-def download_single_band(destination, image, band, region, resolution, band_name=""):
+def request_download(image, name, bands, region, resolution, file_format="GEO_TIFF", grid=None):
+    """
+    Requests the download url of the bands from a gee image and opens the http response as a stream.
+    Args:
+        image (ee.Image): The Earth Engine image object from which the bands will be downloaded.
+        name (str): The name of the downloaded file.
+        bands (list): The names of the bands to download.
+        region (dict): The region to download, specified as a GeoJSON dictionary.
+        resolution (int): The resolution (in meters) for the downloaded image.
+        file_format (str, optional): The format of the download, 'GEO_TIFF' or 'ZIPPED_GEO_TIFF_PER_BAND'. Default is 'GEO_TIFF'.
+        grid (dict, optional): The exact pixel grid to download, with 'crs', 'crs_transform' and 'dimensions', which replaces the region and the resolution. Default is None.
+    Raises:
+        HTTPError: If the request to download the image fails.
+    Returns:
+        requests.Response: The streamed response.
+    """
+
+    params = {
+        "name": name,
+        "bands": list(bands),
+        "format": file_format,
+    }
+    if grid is None:
+        params.update({"region": region, "scale": resolution})
+    else:
+        params.update(grid)
+    with record_stage("url"):
+        image_url = image.getDownloadUrl(params)
+
+    # the time until the response starts, before the transfer of its content
+    with record_stage("request"):
+        response = get_session().get(image_url, timeout=120, stream=True)  # 120 secs timeout
+    if response.status_code != 200:
+        raise response.raise_for_status()
+    return response
+
+
+def download_single_band(destination, image, band, region, resolution, band_name="", chunk_size=DOWNLOAD_CHUNK_SIZE):
     """
     Downloads a single band from a gee image and saves it to the specified destination.
     Args:
@@ -33,8 +94,10 @@ def download_single_band(destination, image, band, region, resolution, band_name
         band (str): The name of the band to download.
         region (dict): The region to download, specified as a GeoJSON dictionary.
         resolution (int): The resolution (in meters) for the downloaded image.
+        chunk_size (int, optional): The number of bytes streamed to disk at a time.
     Raises:
         HTTPError: If the request to download the image fails.
+        IncompleteDownloadError: If the downloaded size does not match the Content-Length.
     Returns:
         None
     """
@@ -46,27 +109,634 @@ def download_single_band(destination, image, band, region, resolution, band_name
     filepath_band = os.path.join(destination, band_name)
 
     # download image with boundle
-    image_url = image.getDownloadUrl(
-        {
-            "name": image_name,
-            "bands": [band],
-            "region": region,
-            "scale": resolution,
-            "format": "GEO_TIFF",
+    response = request_download(image, image_name, [band], region, resolution, "GEO_TIFF")
+    stream_to_file(response, filepath_band.replace(".tif", ".part.tif"), chunk_size=chunk_size)
+    os.rename(filepath_band.replace(".tif", ".part.tif"), filepath_band)
+    return filepath_band
+
+
+def download_multi_bands(destination, image, bands, region, resolution, band_names=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Downloads several bands from a gee image with a single request, and saves each band to the specified destination.
+    Args:
+        destination (str): The directory where the downloaded band images will be saved.
+        image (ee.Image): The Earth Engine image object from which the bands will be downloaded.
+        bands (list): The names of the bands to download.
+        region (dict): The region to download, specified as a GeoJSON dictionary.
+        resolution (int): The resolution (in meters) for the downloaded image.
+        band_names (list, optional): The file names of the bands, in the same order as `bands`.
+        chunk_size (int, optional): The number of bytes streamed to disk at a time.
+    Raises:
+        HTTPError: If the request to download the image fails.
+        IncompleteDownloadError: If the downloaded size does not match the Content-Length.
+    Returns:
+        list: The file paths of the downloaded bands, in the same order as `bands`.
+    """
+
+    # to get the image name from the folderpath
+    image_name = os.path.basename(destination)
+    if band_names is None:
+        band_names = [parse_band_name(image_name, band) for band in bands]
+    filepath_bands = [os.path.join(destination, band_name) for band_name in band_names]
+
+    # download all bands with one boundle, one geotiff per band in a zip file
+    response = request_download(image, image_name, bands, region, resolution, "ZIPPED_GEO_TIFF_PER_BAND")
+    filepath_zip = os.path.join(destination, image_name + ".part.zip")
+    stream_to_file(response, filepath_zip, chunk_size=chunk_size)
+    # split the zip file into the band files
+    extract_zipped_bands(filepath_zip, bands, filepath_bands)
+    os.remove(filepath_zip)
+    return filepath_bands
+
+
+def finalize_band(filepath_band, likeprofile):
+    """
+    Warps a downloaded band to the reference layer and renames it from the part name to the original name.
+    Args:
+        filepath_band (str): The path of the downloaded band, ending with '.part.tif'.
+        likeprofile (dict): The profile of the reference layer.
+    Returns:
+        str: The path of the final band image.
+    """
+
+    # read the profile of the downloaded image
+    band_data, imageprofile = read_image(filepath_band)
+    # warp the image to the reference layer, into the buffer reused by this thread
+    buffer = get_warp_buffer(likeprofile, imageprofile['dtype'])
+    band_data, desprofile = warp_image(band_data, imageprofile, likeprofile, destination=buffer)
+    # save the warped image
+    save_image(filepath_band, band_data, desprofile)
+    # change the part name to the original name
+    os.rename(filepath_band, filepath_band.replace(".part.tif", ".tif"))
+    return filepath_band.replace(".part.tif", ".tif")
+
+
+def download_bands_in_memory(folderpath_image, image, bands, region, resolution, likeprofile, multiband=False, chunk_size=DOWNLOAD_CHUNK_SIZE, writer=None):
+    """
+    Downloads the bands of an image into memory, warps them to the reference layer and writes each band to disk only once.
+    Args:
+        folderpath_image (str): The directory of the image, where the band images will be saved.
+        image (ee.Image): The Earth Engine image object from which the bands will be downloaded.
+        bands (list): The names of the bands to download.
+        region (dict): The region to download, specified as a GeoJSON dictionary.
+        resolution (int): The resolution (in meters) for the downloaded image.
+        likeprofile (dict): The profile of the reference layer.
+        multiband (bool, optional): Whether to download all the bands with a single request. Default is False.
+        chunk_size (int, optional): The number of bytes read from the http response at a time.
+        writer (callable, optional): The function to write a warped band instead of the GeoTIFF, called as writer(band, data, profile). Default is None.
+    Returns:
+        list: The file paths of the band images.
+    """
+
+    image_name = os.path.basename(folderpath_image)
+    # decode the payload straight from memory
+    if multiband:
+        response = request_download(image, image_name, bands, region, resolution, "ZIPPED_GEO_TIFF_PER_BAND")
+        content, _ = stream_to_memory(response, chunk_size=chunk_size)
+        band_images = read_zipped_images(content, bands)
+    else:
+        band_images = []
+        for band in bands:
+            response = request_download(image, image_name, [band], region, resolution, "GEO_TIFF")
+            content, _ = stream_to_memory(response, chunk_size=chunk_size)
+            band_images.append(read_image(content))
+
+    filepath_bands = []
+    for band, (band_data, imageprofile) in zip(bands, band_images):
+        # warp the image to the reference layer, into the buffer reused by this thread
+        buffer = get_warp_buffer(likeprofile, imageprofile['dtype'])
+        band_data, desprofile = warp_image(band_data, imageprofile, likeprofile, destination=buffer)
+        filepath_band = os.path.join(folderpath_image, parse_band_name(image_name, band))
+        if writer is not None:
+            writer(band, band_data, desprofile)
+            filepath_bands.append(filepath_band)
+            continue
+        # save the warped image with a part name, and then change it to the original name
+        save_image(filepath_band.replace(".tif", ".part.tif"), band_data, desprofile)
+        os.rename(filepath_band.replace(".tif", ".part.tif"), filepath_band)
+        filepath_bands.append(filepath_band)
+    return filepath_bands
+
+
+def compute_pixels(image, bands, grid):
+    """
+    Computes the pixels of the bands from a gee image on a grid, and returns them as numpy arrays (Earth Engine's computePixels
+    with NPY output), without any GeoTIFF to encode and decode. The masked pixels are filled with the nodata of each band.
+    Args:
+        image (ee.Image): The Earth Engine image object from which the bands will be computed.
+        bands (list): The names of the bands to compute.
+        grid (dict): The pixel grid, with 'crs', 'crs_transform' and 'dimensions' as for request_download.
+    Returns:
+        list: The (data, profile) of each band, in the same order as `bands`; the profile only contains the data type and nodata.
+    """
+
+    # the fill value of each band is within the range of its type, e.g., not negative for the unsigned angles, so that unmask keeps the type
+    nodata = {band: GEE_HLS_NODATA.get(band, GEE_HLS_NODATA["default"]) for band in bands}
+    scale_x, shear_x, translate_x, shear_y, scale_y, translate_y = grid["crs_transform"]
+    with record_stage("compute", bands=list(bands)):
+        pixels = ee.data.computePixels(
+            {
+                "expression": ee.Image.cat([image.select(band).unmask(nodata[band], False) for band in bands]),
+                "fileFormat": "NUMPY_NDARRAY",
+                "grid": {
+                    "dimensions": {"width": grid["dimensions"][0], "height": grid["dimensions"][1]},
+                    "affineTransform": {
+                        "scaleX": scale_x,
+                        "shearX": shear_x,
+                        "translateX": translate_x,
+                        "shearY": shear_y,
+                        "scaleY": scale_y,
+                        "translateY": translate_y,
+                    },
+                    "crsWkt": grid["crs"],
+                },
+            }
+        )
+    # the bands are the fields of the structured array
+    return [
+        (pixels[band], {"dtype": pixels[band].dtype.name, "nodata": nodata[band]})
+        for band in bands
+    ]
+
+
+def download_bands_tiled(folderpath_image, image, bands, likeprofile, multiband=False, chunk_size=DOWNLOAD_CHUNK_SIZE, tile_size=DOWNLOAD_TILE_SIZE, tile_workers=DOWNLOAD_TILE_WORKERS, writer=None, transport="download", retries=DOWNLOAD_RETRIES, limiter=None):
+    """
+    Downloads the bands of an image over a region too large for a single request, as sub-tiles of the reference grid,
+    and assembles the tiles straight into the band images with windowed writes, without a full-size copy in memory.
+    Each tile is requested on its exact window of the reference grid, so that it needs no warping. The raw arrays from
+    computePixels are always transferred this way, since they are computed on the reference grid too.
+    Args:
+        folderpath_image (str): The directory of the image, where the band images will be saved.
+        image (ee.Image): The Earth Engine image object from which the bands will be downloaded.
+        bands (list): The names of the bands to download.
+        likeprofile (dict): The profile of the reference layer.
+        multiband (bool, optional): Whether to download all the bands of a tile with a single request. Default is False.
+        chunk_size (int, optional): The number of bytes read from the http response at a time.
+        tile_size (int, optional): The maximum number of rows and columns of a tile.
+        tile_workers (int, optional): The number of tiles downloaded at the same time.
+        writer (callable, optional): The function to write a band instead of the GeoTIFF, called as writer(band, data, profile).
+            The band is then assembled in memory. Default is None.
+        transport (str, optional): How the tiles are transferred, 'download' for GeoTIFFs from getDownloadUrl, or 'pixels' for
+            numpy arrays from computePixels. Default is 'download'.
+        retries (int, optional): The maximum number of retries of a tile failing with a transient error. Default is 5.
+        limiter (AdaptiveLimiter, optional): The limiter of the requests in flight, which also bounds the tiles. Default is None.
+    Returns:
+        list: The file paths of the band images.
+    """
+
+    image_name = os.path.basename(folderpath_image)
+    band_groups = [list(bands)] if multiband else [[band] for band in bands]
+    # keep the pixels of a request under the size limit of getDownloadUrl and computePixels, which grow with the bands requested at once
+    tile_size = fit_tile_size(tile_size, len(band_groups[0]))
+    crs = likeprofile['crs'].to_wkt()
+    transform = likeprofile['transform']
+
+    def fetch_tile(window, band_group):
+        row_off, col_off, height, width = window
+        grid = {
+            "crs": crs,
+            "crs_transform": list(transform * Affine.translation(col_off, row_off))[:6],
+            "dimensions": [width, height],
         }
+        if transport == "pixels":
+            return compute_pixels(image, band_group, grid)
+        if multiband:
+            response = request_download(image, image_name, band_group, None, None, "ZIPPED_GEO_TIFF_PER_BAND", grid=grid)
+            content, _ = stream_to_memory(response, chunk_size=chunk_size)
+            return read_zipped_images(content, band_group)
+        response = request_download(image, image_name, band_group, None, None, "GEO_TIFF", grid=grid)
+        content, _ = stream_to_memory(response, chunk_size=chunk_size)
+        return [read_image(content)]
+
+    def fetch_tile_with_retry(window, band_group):
+        # retry a failed tile, not the whole band
+        return call_with_retry(fetch_tile, window, band_group, retries = retries, limiter = limiter)
+
+    windows = split_tiles(likeprofile['width'], likeprofile['height'], tile_size)
+    tasks = [(window, band_group) for band_group in band_groups for window in windows]
+
+    filepath_bands = {band: os.path.join(folderpath_image, parse_band_name(image_name, band)) for band in bands}
+    outputs = {}  # the open band images, or the arrays of the bands with a writer
+    profiles = {}
+    try:
+        for (window, band_group), tile_images in run_bounded(bind_scope(fetch_tile_with_retry), tasks, workers = tile_workers):
+            row_off, col_off, height, width = window
+            for band, (tile_data, tileprofile) in zip(band_group, tile_images):
+                if band not in outputs:
+                    desprofile = likeprofile.copy()
+                    desprofile['dtype'] = tileprofile['dtype']
+                    desprofile['nodata'] = tileprofile['nodata']
+                    profiles[band] = desprofile
+                    if writer is None:
+                        outputs[band] = rasterio.open(filepath_bands[band].replace(".tif", ".part.tif"), 'w', **set_predictor(desprofile))
+                    else:
+                        outputs[band] = np.full(
+                            (likeprofile['height'], likeprofile['width']),
+                            0 if desprofile['nodata'] is None else desprofile['nodata'],
+                            dtype=desprofile['dtype'],
+                        )
+                tile_data = tile_data[:height, :width]
+                if writer is None:
+                    with record_stage("save", window=True):
+                        outputs[band].write(tile_data, 1, window=Window(col_off, row_off, tile_data.shape[1], tile_data.shape[0]))
+                else:
+                    outputs[band][row_off:row_off + tile_data.shape[0], col_off:col_off + tile_data.shape[1]] = tile_data
+    finally:
+        if writer is None:
+            for output in outputs.values():
+                output.close()
+
+    for band in bands:
+        if writer is None:
+            # change the part name to the original name, once all tiles are written
+            os.rename(filepath_bands[band].replace(".tif", ".part.tif"), filepath_bands[band])
+        else:
+            writer(band, outputs[band], profiles[band])
+    return [filepath_bands[band] for band in bands]
+
+
+def download_bands(folderpath_image, image, bands, region, resolution, likeprofile, multiband=False, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Downloads the bands of an image, warps them to the reference layer and saves them with their original names.
+    Args:
+        folderpath_image (str): The directory of the image, where the band images will be saved.
+        image (ee.Image): The Earth Engine image object from which the bands will be downloaded.
+        bands (list): The names of the bands to download.
+        region (dict): The region to download, specified as a GeoJSON dictionary.
+        resolution (int): The resolution (in meters) for the downloaded image.
+        likeprofile (dict): The profile of the reference layer.
+        multiband (bool, optional): Whether to download all the bands with a single request. Default is False.
+        chunk_size (int, optional): The number of bytes streamed to disk at a time.
+    Returns:
+        list: The file paths of the band images.
+    """
+
+    image_name = os.path.basename(folderpath_image)
+    # define the part names for the band images for remaining for further processing
+    band_names = [
+        parse_band_name(image_name, band).replace(".tif", ".part.tif")
+        for band in bands
+    ]
+    if multiband:
+        # download them all at once
+        filepath_bands = download_multi_bands(folderpath_image, image, bands, region, resolution, band_names = band_names, chunk_size = chunk_size)
+    else:
+        filepath_bands = [
+            download_single_band(folderpath_image, image, band, region, resolution, band_name = band_name, chunk_size = chunk_size)
+            for band, band_name in zip(bands, band_names)
+        ]
+    # warp the bands to the reference layer and save them with the original names
+    return [finalize_band(filepath_band, likeprofile) for filepath_band in filepath_bands]
+
+
+def plan_hls(destination, date, extent, bands, sensor="L30", resolution=30, ci=1, cn=1, multiband=False, chunk_size=DOWNLOAD_CHUNK_SIZE, inmemory=False, catalog=False, queue=False, run_id="", local_reference=False, ledger=False, datacube=False, tile_size=DOWNLOAD_TILE_SIZE, transport="download", min_clear=0.0, max_cloud=100, mosaic=False, output_format="gtiff", metrics=False, checksum=False):
+    """
+    Prepares the download of HLS data for a date range and region of interest, i.e., queries the images and gets the reference layer,
+    and returns the download tasks without running them, so that the tasks of several jobs can share one pool of workers.
+    The parameters are the same as hls, except workers and retries.
+    Returns:
+        dict: The job, containing:
+            - tasks (generator): The download tasks, created lazily as the images are reached.
+            - run_task (callable): The function to run a task, called as run_task(*task, retries=retries, limiter=limiter),
+              which retries the requests of the task failing with a transient error.
+            - complete (callable): The function to call with a task and its result once it is done, to track the progress.
+            - finish (callable): The function to call once all tasks are done.
+            - scope (callable): The function returning the scope of the metrics of a task, called as scope(task).
+            - metrics (MetricsRecorder): The recorder of the metrics of the job.
+    """
+
+
+    # check if bands is empty
+    gee_hls_address, bands = parse_hls_sensor(sensor, bands)
+    if transport not in ("download", "pixels"):
+        raise ValueError("Invalid transport. Please specify either 'download' or 'pixels'.")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output format. Please choose from: {', '.join(OUTPUT_FORMATS)}")
+    if queue:
+        # the queue of an earlier run, e.g., of an earlier invocation, would skip the images it has marked as done
+        run_id = run_id or os.environ.get("SLURM_ARRAY_JOB_ID", "")
+        if not run_id:
+            raise ValueError("A queue needs the run_id shared by the processes of the run, e.g., the SLURM array job ID.")
+
+    # convert date to date_start and date_end
+    date_start, date_end = parse_gee_date(date)
+    # convert extent to gee format
+    roi_gee = parse_gee_roi(extent)
+    # path
+    destination = Path(destination)
+
+    # the metrics of this task, i.e., the duration of each stage, the bytes transferred and the retries
+    task_name = f"{sensor}_{ci:09d}_{cn:09d}"
+    recorder = MetricsRecorder(
+        destination.joinpath("metrics", f"{task_name}.jsonl") if metrics else None, task = task_name
     )
 
-    response = requests.get(image_url, timeout=120, stream=True)  # 120 secs timeout
-    if response.status_code != 200:
-        raise response.raise_for_status()
+    # the queries and the reference layer are recorded as the stages of planning
+    with recorder.scope(image = "plan"):
+        # see details at https://developers.google.com/earth-engine/datasets/catalog/NASA_HLS_HLSL30_v002
+        # get the list of the selected images, with the scene IDs and key properties only
+        collection = (
+            ee.ImageCollection(gee_hls_address)
+            .filterDate(date_start, date_end)
+            .filterBounds(roi_gee)
+        )
+        if catalog:
+            destination.mkdir(parents=True, exist_ok=True)
+            image_list_loc = query_scenes(
+                destination.joinpath("catalog.sqlite"), gee_hls_address, date_start, date_end, roi_gee
+            )
+        else:
+            image_list_loc = fetch_scenes(collection, date_start = date_start, date_end = date_end)
 
-    with open(filepath_band.replace(".tif", ".part.tif"), "wb") as fd:
-        fd.write(response.content)
-    os.rename(filepath_band.replace(".tif", ".part.tif"), filepath_band)
-    return filepath_band
+        if not image_list_loc:
+            print(f"No {sensor} scene has been found from {date_start} to {date_end} over the extent.")
+
+            def finish_empty():
+                recorder.report()
+                recorder.close()
+            return {
+                "tasks": iter(()),
+                "run_task": None,
+                "complete": None,
+                "finish": finish_empty,
+                "scope": None,
+                "metrics": recorder,
+            }
+
+        # composite the tiles of the same date into one image, instead of downloading their overlaps onto the grid again and again,
+        # before the screening, as a tile near its edge only observes a part of the roi
+        if mosaic:
+            image_list_loc = group_scenes(image_list_loc)
+        # the reference layer is taken from the scenes before the screening, so that its grid does not depend on the screening
+        # parameters, nor fails when few scenes pass it
+        scenes_reference = image_list_loc
+
+        # skip the clouded scenes before downloading, and record their clear fractions for the run
+        if min_clear > 0 or max_cloud < 100:
+            destination.mkdir(parents=True, exist_ok=True)
+            len_scenes = len(image_list_loc)
+            image_list_loc = screen_scenes(
+                collection,
+                image_list_loc,
+                roi_gee,
+                min_clear=min_clear,
+                max_cloud=max_cloud,
+                filepath_screening=destination.joinpath(f"screening_{sensor}.json"),
+            )
+            print(f"{len(image_list_loc)} of {len_scenes} {'mosaics' if mosaic else 'scenes'} have passed the cloud screening.")
+            recorder.record("screening", scenes = len_scenes, passed = len(image_list_loc))
+
+        folderpath_data = destination.joinpath("HLS")
+        folderpath_data.mkdir(parents=True, exist_ok=True)
+
+        # the reference layer downloaded by this process only, which is removed at the end
+        filepath_reference_task = None
+        if extent.endswith(".tif"):
+            # using a geotiff file as the reference layer
+            likeprofile, likepcrs, liketransformer = get_reference_profile(extent)
+        elif local_reference and not os.path.isfile(destination.joinpath(parse_reference_name(ci=1))):
+            # build the reference layer from the roi, the resolution and the utm zone of the first image, without downloading
+            filepath_reference = destination.joinpath(parse_reference_name(ci=1).replace(".tif", ".json"))
+            if not os.path.isfile(filepath_reference):
+                create_reference_profile(
+                    filepath_reference,
+                    get_roi_bounds(roi_gee),
+                    resolution,
+                    get_utm_crs(scenes_reference[0]["system:index"]),
+                )
+            likeprofile, likepcrs, liketransformer = get_reference_profile(filepath_reference)
+            print(
+                "The reference layer has been created locally with the UTM zone of the first image from the GEE archive."
+            )
+        else:
+            # download the first image of gee archieve as reference layer
+            scene_reference = scenes_reference[1] if len(scenes_reference) > 1 else scenes_reference[0]
+            image = ee.Image(gee_hls_address + "/" + scene_reference["system:index"])
+            if mosaic:
+                # the tiles of the date together cover the roi near the tile edges
+                image = ee.ImageCollection(
+                    [ee.Image(gee_hls_address + "/" + system_index) for system_index in scene_reference["scenes"]]
+                ).mosaic().setDefaultProjection(image.select("B5").projection())
+            filepath_reference = destination.joinpath(parse_reference_name(ci=1))
+            filepath_reference_ci = destination.joinpath(parse_reference_name(ci=ci, cn=cn))
+            if not os.path.isfile(filepath_reference) and os.path.isfile(filepath_reference_ci):
+                # the reference layer of this task is already downloaded by another job in the same destination, e.g., the other sensor
+                filepath_reference = filepath_reference_ci
+                if ci > 1:
+                    filepath_reference_task = filepath_reference
+            elif not os.path.isfile(filepath_reference):
+                reference_image_band = parse_reference_name(ci=ci, cn=cn)
+                filepath_reference = call_with_retry(
+                    download_single_band,
+                    str(destination),
+                    image,
+                    "B5",
+                    roi_gee,
+                    resolution,
+                    band_name=reference_image_band,
+                )  # any band is ok, here we used B5
+                if ci > 1:
+                    filepath_reference_task = filepath_reference
+            likeprofile, likepcrs, liketransformer = get_reference_profile(filepath_reference)
+            print(
+                "The reference layer has been downloaded with the first image from the GEE archive."
+            )
+
+    # the band images are written with the creation options of the output format, on the grid of the reference layer
+    likeprofile = get_output_profile(likeprofile, output_format)
+
+    print(f"Start downloading the HLS data from {date_start} to {date_end}:")
+    
+
+    # split the image list in parallel by ci and cn
+    len_images = len(image_list_loc)
+    # the number of unfinished tasks of each image, to report the progress once an image is completed
+    tasks_unfinished = {}
+
+    # to get the image names, i.e., T18SUH_20200112T154027
+    if mosaic:
+        # to get the mosaic names, i.e., MOSAIC_20200112
+        image_names = [sensor + "_MOSAIC_" + image_loc["date"] for image_loc in image_list_loc]
+    else:
+        image_names = [sensor + "_" + image_loc["system:index"] for image_loc in image_list_loc]
+    if queue:
+        # claim the images from the queue shared by the processes of the run
+        filepath_queue = destination.joinpath("queue.sqlite")
+        queue_run = json.dumps([run_id, sensor, date_start, date_end, extent, list(bands), mosaic])
+        image_positions = {image_name: i for i, image_name in enumerate(image_names)}
+        image_indices = (
+            image_positions[image_name]
+            for image_name in claim_tasks(filepath_queue, queue_run, image_names, lease=QUEUE_LEASE)
+        )
+        # the images claimed by this process are not known in advance, at most all of them
+        recorder.total = len_images
+        recorder.gauges["queue_pending"] = lambda: count_tasks(filepath_queue, queue_run)
+    else:
+        # using ic and cn to access the image list
+        image_indices = range(ci - 1, len_images, cn)
+        recorder.total = len(image_indices)
+
+    # the bands written into the datacube are only known from the ledger
+    if datacube:
+        ledger = True
+        folderpath_cube = str(destination.joinpath(f"HLS_{sensor}_MOSAIC.zarr" if mosaic else f"HLS_{sensor}.zarr"))
+        cube_positions = open_datacube(
+            folderpath_cube,
+            [
+                {"name": image_name, "system:time_start": image_loc["system:time_start"]}
+                for image_name, image_loc in zip(image_names, image_list_loc)
+            ],
+            likeprofile,
+        )
+
+    # the completed bands from the ledger, read at once instead of checking each band file
+    if datacube:
+        # the datacube has its own ledger, as the band files are not in it
+        filepath_ledger = os.path.join(folderpath_cube, "ledger.jsonl")
+        bands_completed = load_ledger(filepath_ledger, None)
+    elif ledger:
+        filepath_ledger = destination.joinpath("ledger.jsonl")
+        bands_completed = load_ledger(filepath_ledger, folderpath_data)
+    else:
+        bands_completed = None
+
+    def iterate_tasks():
+        for i in image_indices:
+            image_loc = image_list_loc[i]
+            image_name = image_names[i]
+            folderpath_image = folderpath_data.joinpath(image_name)
+            if not ledger:
+                folderpath_image.mkdir(parents=True, exist_ok=True)
+
+            # check existing bands
+            bands_lack = filter_missing_bands(
+                str(folderpath_image), image_name, bands, completed = bands_completed
+            )  # to get the bands that need to be downloaded
+            if len(bands_lack) == 0:
+                if queue:
+                    complete_task(filepath_queue, queue_run, image_name)
+                recorder.complete(image_name, position = i + 1, skipped = True)
+                continue
+            if ledger and not datacube:
+                folderpath_image.mkdir(parents=True, exist_ok=True)
+
+            # download the missing bands, all at once or one task per band
+            if mosaic:
+                # the clearest scene is the last one, on top of the mosaic
+                image_gee = ee.ImageCollection(
+                    [ee.Image(gee_hls_address + "/" + system_index) for system_index in image_loc["scenes"]]
+                ).mosaic()
+            else:
+                image_gee = ee.Image(gee_hls_address + "/" + image_loc["system:index"])
+            image_gee = image_gee.reproject(crs=likepcrs, crsTransform=liketransformer)
+            band_groups = [bands_lack] if multiband else [[band] for band in bands_lack]
+            tasks_unfinished[i] = len(band_groups)
+            for band_group in band_groups:
+                yield (i, image_name, str(folderpath_image), image_gee, band_group)
 
+    def run_task(i, image_name, folderpath_image, image_gee, band_group, retries=DOWNLOAD_RETRIES, limiter=None):
+        # the regions too large for a single request of the bands are downloaded as tiles, each one retried on its own,
+        # so that a failed tile does not download the others again
+        tiled = max(likeprofile['width'], likeprofile['height']) > fit_tile_size(tile_size, len(band_group)) or transport == "pixels"
+        writer = None
+        if datacube:
+            # write the warped bands into the datacube, instead of the GeoTIFFs
+            def writer(band, band_data, desprofile):
+                with record_stage("datacube"):
+                    write_datacube(folderpath_cube, band, cube_positions[image_name], band_data, desprofile)
+        if tiled:
+            filepath_bands = download_bands_tiled(folderpath_image, image_gee, band_group, likeprofile, multiband = multiband, chunk_size = chunk_size, tile_size = tile_size, writer = writer, transport = transport, retries = retries, limiter = limiter)
+        elif inmemory or datacube:
+            filepath_bands = call_with_retry(download_bands_in_memory, folderpath_image, image_gee, band_group, roi_gee, resolution, likeprofile, multiband = multiband, chunk_size = chunk_size, writer = writer, retries = retries, limiter = limiter)
+        else:
+            filepath_bands = call_with_retry(download_bands, folderpath_image, image_gee, band_group, roi_gee, resolution, likeprofile, multiband = multiband, chunk_size = chunk_size, retries = retries, limiter = limiter)
+        if datacube:
+            return [
+                {"file": os.path.basename(filepath_band), "size": None, "md5": None, "datacube": os.path.basename(folderpath_cube)}
+                for filepath_band in filepath_bands
+            ]
+        if ledger:
+            # describe the bands in the worker, which only reads them back with checksum
+            return [describe_band(filepath_band, checksum = checksum) for filepath_band in filepath_bands]
+        return filepath_bands
 
-def hls(destination, date, extent, bands, sensor="L30", resolution=30, ci=1, cn=1):
+    def complete(task, result):
+        i, image_name = task[0], task[1]
+        if ledger:
+            append_ledger(filepath_ledger, result)
+        tasks_unfinished[i] -= 1
+        if tasks_unfinished[i] == 0:
+            del tasks_unfinished[i]
+            if queue:
+                complete_task(filepath_queue, queue_run, image_name)
+            recorder.complete(image_name, position = i + 1)
+        elif queue:
+            # keep the image from being claimed by others while its bands are downloading
+            renew_task(filepath_queue, queue_run, image_name, lease=QUEUE_LEASE)
+
+    def finish():
+        if (
+            filepath_reference_task is not None
+        ):  # remove reference layer, but only reserve the first reference layer as normal layer
+            # the jobs sharing the reference layer of the task all finish here, so it may be removed already
+            try:
+                os.remove(filepath_reference_task)
+            except FileNotFoundError:
+                pass
+        recorder.report()
+        recorder.close()
+
+    def scope(task):
+        return recorder.scope(image = task[1], bands = list(task[4]))
+
+    return {
+        "tasks": iterate_tasks(),
+        "run_task": run_task,
+        "complete": complete,
+        "finish": finish,
+        "scope": scope,
+        "metrics": recorder,
+    }
+
+
+def run_jobs(jobs, workers=1, retries=DOWNLOAD_RETRIES):
+    """
+    Runs the tasks of the jobs planned by plan_hls in one pool of workers, taking the tasks from the jobs in turn.
+    The requests of a task failing with a transient error, e.g., a 429 or 5xx response, are retried with backoff, i.e., the
+    band or each of its tiles, and the number of requests in flight adapts to the throttling.
+    Args:
+        jobs (list): The jobs returned by plan_hls.
+        workers (int, optional): The maximum number of threads. Default is 1.
+        retries (int, optional): The maximum number of retries of a request of a task, e.g., a band or a tile. Default is 5.
+    Returns:
+        None
+    """
+
+    # start with half of the workers in flight, and adapt to the quota
+    limiter = AdaptiveLimiter(max(1, workers // 2), maximum = workers)
+
+    def run_task(job, task):
+        # the task retries its requests itself, e.g., each tile of a band, so that the retries happen at one level only
+        with job["scope"](task):
+            return job["run_task"](*task, retries = retries, limiter = limiter)
+
+    for job in jobs:
+        job["metrics"].gauges.update(in_flight = lambda: limiter.inflight, limit = lambda: int(limiter.limit))
+
+    def job_tasks(job):
+        # bind the job now, as a generator expression in the list would only look it up once it is consumed
+        return ((job, task) for task in job["tasks"])
+
+    tasks = interleave_tasks([job_tasks(job) for job in jobs])
+    # share the keep-alive connections among the workers
+    get_session(pool_size=max(workers, 10))
+    for (job, task), result in run_bounded(run_task, tasks, workers = workers):
+        job["complete"](task, result)
+    for job in jobs:
+        job["finish"]()
+
+
+def hls(destination, date, extent, bands, sensor="L30", resolution=30, ci=1, cn=1, multiband=False, workers=1, chunk_size=DOWNLOAD_CHUNK_SIZE, inmemory=False, catalog=False, queue=False, run_id="", local_reference=False, retries=DOWNLOAD_RETRIES, ledger=False, datacube=False, tile_size=DOWNLOAD_TILE_SIZE, transport="download", min_clear=0.0, max_cloud=100, mosaic=False, output_format="gtiff", metrics=False, checksum=False):
     """
     Downloads Harmonized Landsat and Sentinel-2 (HLS) data from Google Earth Engine (GEE) for a specified date range and region of interest.
 
@@ -79,6 +749,25 @@ def hls(destination, date, extent, bands, sensor="L30", resolution=30, ci=1, cn=
     resolution (int, optional): The spatial resolution of the downloaded images. Default is 30 meters.
     ci (int, optional): The index of the current parallel process. Default is 1.
     cn (int, optional): The total number of parallel processes. Default is 1.
+    multiband (bool, optional): Whether to download all missing bands of an image with a single request. Default is False.
+    workers (int, optional): The number of threads downloading and warping the bands at the same time within this process. Default is 1.
+    chunk_size (int, optional): The number of bytes streamed from the http response to disk at a time. Default is 1 MiB.
+    inmemory (bool, optional): Whether to decode and warp the downloaded bands in memory, so that each band is written to disk only once. Default is False.
+    catalog (bool, optional): Whether to cache the list of scenes in 'catalog.sqlite' under the destination, so that later runs only query the new acquisitions. Default is False.
+    queue (bool, optional): Whether the parallel processes claim the images one by one from a queue in 'queue.sqlite' under the destination, instead of splitting the image list by ci and cn. Default is False.
+    run_id (str, optional): The identifier shared by the parallel processes of a run, e.g., the SLURM array job ID, to separate the queue of this run from the previous ones; required by queue, which falls back to the SLURM_ARRAY_JOB_ID environment variable. Default is "".
+    local_reference (bool, optional): Whether to build the reference layer from the ROI, the resolution and the UTM zone of the first image, instead of downloading it. Default is False.
+    retries (int, optional): The maximum number of retries of a band (an image with multiband, or a tile of either) failing with a transient error, e.g., a 429 or 5xx response. Default is 5.
+    ledger (bool, optional): Whether to record the completed bands with their size in 'ledger.jsonl' under the destination, and resume from it instead of checking each band file. Default is False.
+    datacube (bool, optional): Whether to write the warped bands into the Zarr datacube 'HLS_<sensor>.zarr' under the destination, with one (time, y, x) array per band, instead of one GeoTIFF per band. Default is False.
+    tile_size (int, optional): The maximum number of rows and columns downloaded by one request; larger regions are downloaded as tiles of the reference grid, which shrink with the bands of a multiband request to stay under the request size limit of GEE. Default is 2048.
+    min_clear (float, optional): The minimum fraction of the ROI observed clear of cloud and cloud shadow by a scene, from 0 to 1, computed from the Fmask band on the server before downloading; the fractions are recorded in 'screening_<sensor>.json' under the destination. Default is 0, i.e., no screening.
+    max_cloud (float, optional): The maximum cloud coverage of the whole tile of a scene, in percent, from its 'CLOUD_COVERAGE' property. Default is 100.
+    mosaic (bool, optional): Whether to composite the scenes of the same date, i.e., the neighboring MGRS tiles of an overpass, into one image on the server, saved as '<sensor>_MOSAIC_<YYYYMMDD>', with the clearest tile on top. The screening applies to the mosaic of each date, with the cloud coverage of its clearest tile. Default is False.
+    output_format (str, optional): The format of the band images, "gtiff" with the profile of the reference layer, "deflate" or "zstd" for tiled GeoTIFFs compressed with a predictor, or "cog" for Cloud-Optimized GeoTIFFs with overviews; the compression is encoded by all cores. Default is "gtiff".
+    metrics (bool, optional): Whether to record the metrics of the task as JSON lines in 'metrics/<sensor>_<ci>_<cn>.jsonl' under the destination, i.e., the duration of each stage of each band, the bytes transferred, the retries and the progress, which can be merged across tasks by aggregate_metrics. The progress, i.e., the throughput and the estimated time left, is printed every minute either way. Default is False.
+    transport (str, optional): How the pixels are transferred, "download" for GeoTIFFs from getDownloadUrl, or "pixels" for raw numpy arrays on the reference grid from computePixels, which are written without decoding or warping. Default is "download".
+    checksum (bool, optional): Whether to also record the md5 checksum of each band in the ledger, which reads each band image back once written. Default is False.
 
     Returns:
     None
@@ -86,104 +775,60 @@ def hls(destination, date, extent, bands, sensor="L30", resolution=30, ci=1, cn=
     Notes:
     - The function will create a directory structure under the specified destination to store the downloaded data.
     - If the extent is not a GeoTIFF file, the function will download the first image from the GEE archive as a reference layer.
+    - The reference layer is downloaded with a single request, so an extent larger than the request size limit of GEE, i.e., about 48 MB of the B5 band, needs local_reference.
+    - With local_reference, the reference layer is saved as 'reference_layer.json' and shared by all processes; an existing 'reference_layer.tif' is still used first to keep the grid of earlier downloads.
     - The function supports parallel downloading by splitting the image list based on the ci and cn parameters.
+    - With queue, an image claimed by a process that dies is claimed again by another process once its lease expires.
     - The downloaded images will be reprojected to match the reference layer and saved in GeoTIFF format.
+    - With multiband, the missing bands of an image are fetched as one zip file and split locally into the same band files.
+    - With more than one worker, the bands (or the images with multiband) are processed by a pool of threads sharing one http session.
+    - With inmemory, the whole payload of a request is held in memory instead of being streamed to disk in chunks.
+    - With ledger, a band is taken as completed once it is in the ledger; the first run scans the existing band files once to start the ledger.
+    - With datacube, the bands are warped in memory and a ledger inside the datacube is used to resume; the writes of the processes to a chunk are serialized by lock files.
+    - A region larger than tile_size is split into tiles of the reference grid, downloaded concurrently and written straight into the band images.
+    - The number of requests in flight starts at half of the workers, grows while they succeed, and is halved when they are throttled.
     """
 
-    # check if bands is empty
-    if sensor == "L30":
-        gee_hls_address = GEE_HLSL30_ADDRESS
-        if bands == "":
-            bands = GEE_HLSL30_BANDS
-    elif sensor == "S30":
-        gee_hls_address = GEE_HLSS30_ADDRESS
-        if bands == "":
-            bands = GEE_HLSS30_BANDS
-    else:
-        raise ValueError("Invalid sensor type. Please specify either 'L30' or 'S30'.")
-
-    # convert date to date_start and date_end
-    date_start, date_end = parse_gee_date(date)
-    # convert extent to gee format
-    roi_gee = parse_gee_roi(extent)
-    # path
-    destination = Path(destination)
-
-    # see details at https://developers.google.com/earth-engine/datasets/catalog/NASA_HLS_HLSL30_v002
-    # get the image collection
-    collection = (
-        ee.ImageCollection(gee_hls_address)
-        .filterDate(date_start, date_end)
-        .filterBounds(roi_gee)
+    job = plan_hls(
+        destination,
+        date,
+        extent,
+        bands,
+        sensor = sensor,
+        resolution = resolution,
+        ci = ci,
+        cn = cn,
+        multiband = multiband,
+        chunk_size = chunk_size,
+        inmemory = inmemory,
+        catalog = catalog,
+        queue = queue,
+        run_id = run_id,
+        local_reference = local_reference,
+        ledger = ledger,
+        datacube = datacube,
+        tile_size = tile_size,
+        transport = transport,
+        min_clear = min_clear,
+        max_cloud = max_cloud,
+        mosaic = mosaic,
+        output_format = output_format,
+        metrics = metrics,
+        checksum = checksum,
     )
-    # get the list of the selected images
-    image_list_gee = ee.List(collection.toList(collection.size()))
-    image_list_loc = image_list_gee.getInfo()
-
-    folderpath_data = destination.joinpath("HLS")
-    folderpath_data.mkdir(parents=True, exist_ok=True)
-
-    if not extent.endswith(".tif"):
-        # download the first image of gee archieve as reference layer
-        image = ee.Image(image_list_gee.get(1))
-        filepath_reference = destination.joinpath(parse_reference_name(ci=1))
-        if not os.path.isfile(filepath_reference):
-            reference_image_band = parse_reference_name(ci=ci, cn=cn)
-            filepath_reference = download_single_band(
-                str(destination),
-                image,
-                "B5",
-                roi_gee,
-                resolution,
-                band_name=reference_image_band,
-            )  # any band is ok, here we used B5
-        likeprofile, likepcrs, liketransformer = get_reference_profile(filepath_reference)
-        print(
-            "The reference layer has been downloaded with the first image from the GEE archive."
-        )
-    else:
-        # using a geotiff file as the reference layer
-        likeprofile, likepcrs, liketransformer = get_reference_profile(extent)  
+    run_jobs([job], workers = workers, retries = retries)
 
-    print(f"Start downloading the HLS data from {date_start} to {date_end}:")
-    
 
-    # split the image list in parallel by ci and cn
-    len_images = len(image_list_loc)
-    # using ic and cn to access the image list
-    for i in range(ci - 1, len_images, cn):
-        image_loc = image_list_loc[i]
-        # to get the image name, i.e., T18SUH_20200112T154027
-        image_name = sensor + "_" + image_loc["properties"]["system:index"]
-        folderpath_image = folderpath_data.joinpath(image_name)
-        folderpath_image.mkdir(parents=True, exist_ok=True)
-
-        # check existing bands
-        bands_lack = filter_missing_bands(
-            str(folderpath_image), image_name, bands
-        )  # to get the bands that need to be downloaded
-        if len(bands_lack) == 0:
-            continue
+def hls_batch(jobs, workers=1, retries=DOWNLOAD_RETRIES):
+    """
+    Downloads the HLS data of several jobs, e.g., sites and sensors, in one process, with the tasks of all jobs interleaved in one pool of workers.
+    Args:
+        jobs (list): The jobs, each one a dictionary of the parameters of hls except workers and retries, e.g.,
+            {'destination': '/data/SERC', 'date': '20130411-20241231', 'extent': '[-76.67,38.82,-76.43,38.99]', 'bands': ['B2', 'Fmask'], 'sensor': 'L30'}.
+        workers (int, optional): The number of threads downloading and warping the bands at the same time. Default is 1.
+        retries (int, optional): The maximum number of retries of a request, e.g., a band or a tile, failing with a transient error. Default is 5.
+    Returns:
+        None
+    """
 
-        # download the missing bands
-        image_gee = ee.Image(image_list_gee.get(i)).reproject(
-            crs=likepcrs, crsTransform=liketransformer
-        )
-        for band in bands_lack:
-            # define a part name for the band image for remaining for further processing
-            band_name = parse_band_name(image_name, band).replace(".tif", ".part.tif")
-            # download the band
-            filepath_band = download_single_band(str(folderpath_image), image_gee, band, roi_gee, resolution, band_name = band_name)
-            # read the profile of the downloaded image
-            band_data, imageprofile = read_image(filepath_band)
-            # warp the image to the reference layer
-            band_data, desprofile = warp_image(band_data, imageprofile, likeprofile)
-            # save the warped image
-            save_image(filepath_band, band_data, desprofile)
-            # change the part name to the original name
-            os.rename(filepath_band, filepath_band.replace(".part.tif", ".tif"))
-        print(f"{i + 1:09d}/{len_images:09d} {image_name}")
-    if (
-        ci > 1
-    ):  # remove reference layer, but only reserve the first reference layer as normal layer
-        os.remove(filepath_reference)
+    run_jobs([plan_hls(**job) for job in jobs], workers = workers, retries = retries)
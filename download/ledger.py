@@ -0,0 +1,119 @@
+'''
+record the completed band images of a destination in a ledger, to resume downloads without probing every file
+'''
+
+import os
+import json
+import hashlib
+import threading
+
+# serialize the appends of the threads of this process; each record is one write, which is atomic across processes with O_APPEND
+_ledger_lock = threading.Lock()
+
+def describe_band(filepath_band, checksum=False, chunk_size=1024 * 1024):
+    """
+    Describes a completed band image for the ledger, with its size and, optionally, its checksum.
+    Args:
+        filepath_band (str): The path of the band image.
+        checksum (bool, optional): Whether to read the band image back to compute its md5 checksum. Default is False.
+        chunk_size (int, optional): The number of bytes read at a time to compute the checksum. Default is 1 MiB.
+    Returns:
+        dict: The record of the band, containing the file name, the size in bytes and the md5 checksum, or None without checksum.
+    """
+
+    digest = None
+    if checksum:
+        hasher = hashlib.md5()
+        with open(filepath_band, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+    return {
+        'file': os.path.basename(filepath_band),
+        'size': os.path.getsize(filepath_band),
+        'md5': digest,
+    }
+
+def append_ledger(filepath_ledger, records):
+    """
+    Appends the records of completed band images to the ledger.
+    Args:
+        filepath_ledger (str): The path of the ledger, a JSON Lines file which is created if it does not exist.
+        records (list): The records, as returned by describe_band.
+    """
+
+    with _ledger_lock:
+        fd = os.open(filepath_ledger, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            for record in records:
+                os.write(fd, (json.dumps(record) + '\n').encode())
+        finally:
+            os.close(fd)
+
+def read_ledger(filepath_ledger):
+    """
+    Reads the ledger with a single read.
+    Args:
+        filepath_ledger (str): The path of the ledger.
+    Returns:
+        dict: The records of the completed band images by file name, or an empty dict if the ledger does not exist.
+    """
+
+    records = {}
+    if not os.path.isfile(filepath_ledger):
+        return records
+    with open(filepath_ledger) as f:
+        content = f.read()
+    for line in content.splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue  # a line cut off by a process that died while writing it
+        records[record['file']] = record
+    return records
+
+def scan_completed_bands(folderpath_data):
+    """
+    Lists the band images already in the data folder, i.e., downloaded before the ledger was used,
+    with one os.scandir pass per image folder and no stat of the files.
+    Args:
+        folderpath_data (str): The data folder, containing one folder per image.
+    Returns:
+        list: The records of the band images, without the size and checksum.
+    """
+
+    records = []
+    if not os.path.isdir(folderpath_data):
+        return records
+    with os.scandir(folderpath_data) as image_entries:
+        for image_entry in image_entries:
+            if not image_entry.is_dir():
+                continue
+            with os.scandir(image_entry.path) as band_entries:
+                for band_entry in band_entries:
+                    if band_entry.name.endswith('.tif') and not band_entry.name.endswith('.part.tif'):
+                        records.append({'file': band_entry.name, 'size': None, 'md5': None})
+    return records
+
+def load_ledger(filepath_ledger, folderpath_data):
+    """
+    Loads the completed band images of a destination from its ledger. If there is no ledger yet,
+    the band images already in the data folder are scanned once and recorded as the start of the ledger.
+    Args:
+        filepath_ledger (str): The path of the ledger.
+        folderpath_data (str): The data folder, containing one folder per image, or None to start an empty ledger.
+    Returns:
+        dict: The records of the completed band images by file name.
+    """
+
+    if not os.path.isfile(filepath_ledger):
+        # write the scanned records aside, and link them as the ledger only if no other process has started it meanwhile
+        filepath_temp = f'{filepath_ledger}.{os.getpid()}.part'
+        append_ledger(filepath_temp, scan_completed_bands(folderpath_data) if folderpath_data is not None else [])
+        try:
+            os.link(filepath_temp, filepath_ledger)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(filepath_temp)
+    return read_ledger(filepath_ledger)
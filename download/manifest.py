@@ -0,0 +1,74 @@
+'''
+read the manifest of batch downloads
+'''
+
+import json
+import inspect
+
+def load_manifest(filepath_manifest):
+    """
+    Loads a manifest of download jobs from a JSON or YAML file, and expands it into the jobs of hls_batch.
+    The manifest contains the parameters shared by all jobs under 'defaults', and the jobs, e.g., the sites, under 'jobs'.
+    A job can list several sensors with their bands under 'sensors', which is expanded into one job per sensor:
+        defaults:
+          date: 20130411-20241231
+        jobs:
+          - destination: /data/SERC
+            extent: "[-76.6684662,38.82467197,-76.42889892,38.98579013]"
+            sensors:
+              L30: B2,B3,B4,B5,B6,B7,Fmask
+              S30: B2,B3,B4,B8A,B11,B12,Fmask
+    Args:
+        filepath_manifest (str): The path of the manifest, ending with .json, .yaml or .yml.
+    Raises:
+        ValueError: If a job does not have a destination, a date or an extent, or has a key that is not a parameter of a job,
+            e.g., the workers and the retries of the run, checked before any job is planned.
+    Returns:
+        list: The jobs, each one a dictionary of the parameters of hls except workers and retries, which apply to the run.
+    """
+
+    with open(filepath_manifest) as f:
+        if str(filepath_manifest).endswith(('.yaml', '.yml')):
+            import yaml  # only required for yaml manifests
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    from .download import plan_hls  # the parameters of a job
+    parameters = inspect.signature(plan_hls).parameters
+
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for job in manifest['jobs']:
+        job = {**defaults, **job}
+        # one job per sensor
+        sensors = job.pop('sensors', {job.get('sensor', 'L30'): job.get('bands', '')})
+        for sensor, bands in sensors.items():
+            job_sensor = {**job, 'sensor': sensor, 'bands': parse_bands(bands)}
+            for key in ('destination', 'date', 'extent'):
+                if key not in job_sensor:
+                    raise ValueError(f"The job {job_sensor} does not have the {key}.")
+            for key in job_sensor:
+                if key not in parameters:
+                    raise ValueError(f"The job {job_sensor} has the key {key}, which is not a parameter of a job.")
+            # the extent and date may be read as numbers or lists from yaml or json
+            job_sensor['date'] = str(job_sensor['date'])
+            if not isinstance(job_sensor['extent'], str):
+                job_sensor['extent'] = json.dumps(job_sensor['extent'])
+            jobs.append(job_sensor)
+    return jobs
+
+def parse_bands(bands):
+    """
+    Converts the bands of a job into a list of band names.
+    Args:
+        bands (str or list): The bands as a comma-separated string or a list. An empty string means all bands.
+    Returns:
+        list or str: The list of band names, or an empty string for all bands.
+    """
+
+    if isinstance(bands, str):
+        if bands == '':
+            return ''
+        return [band.strip() for band in bands.split(',')]
+    return list(bands)
@@ -0,0 +1,222 @@
+'''
+record the timing and the progress of the downloads as JSON lines, one file per task, and aggregate the files of all tasks
+'''
+
+import os
+import json
+import time
+import glob
+import socket
+import threading
+from contextlib import contextmanager
+from .constants import METRICS_INTERVAL
+
+# the recorder and the fields of the scope, i.e., the image and the bands, of the work running in each thread
+_scopes = threading.local()
+
+
+class MetricsRecorder:
+    """
+    Records the events of a download task, e.g., the duration of each stage of a band, the bytes transferred and the retries,
+    as JSON lines, and reports the throughput and the estimated time left every `interval` seconds.
+    """
+
+    def __init__(self, filepath=None, task="", total=0, interval=METRICS_INTERVAL):
+        """
+        Args:
+            filepath (str, optional): The path of the JSONL file, which is appended to. Default is None to only report the progress.
+            task (str, optional): The name of the task, i.e., 'L30_000000001_000000020' for the sensor, ci and cn. Default is ''.
+            total (int, optional): The number of images expected to be completed by the task, for the estimated time left. Default is 0.
+            interval (float, optional): The seconds between two reports of the progress. Default is 60.
+        """
+        self.filepath = filepath
+        self.task = task
+        self.total = total
+        self.interval = interval
+        self.completed = 0
+        self.gauges = {}  # the functions returning the current values reported with the progress, e.g., the requests in flight
+        self.time_start = time.time()
+        self.time_report = self.time_start
+        self._lock = threading.Lock()
+        self._fd = None
+        if filepath is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+            # append each line with a single write, so that the lines of the processes sharing the file are not mixed
+            self._fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.record("start")
+
+    def record(self, event, **fields):
+        """
+        Records an event, with the fields of the current scope.
+        Args:
+            event (str): The name of the event, e.g., 'stage', 'retry', 'image' or 'progress'.
+            **fields: The fields of the event.
+        """
+        line = {"time": round(time.time(), 3), "task": self.task, "host": socket.gethostname(), "pid": os.getpid(), "event": event}
+        if getattr(_scopes, "recorder", None) is self:
+            line.update(_scopes.fields)
+        line.update(fields)
+        if self._fd is not None:
+            data = (json.dumps(line, default=str) + "\n").encode()
+            with self._lock:
+                os.write(self._fd, data)
+
+    @contextmanager
+    def scope(self, **fields):
+        """
+        Makes this recorder the one of the current thread, and adds the fields to the events recorded within the scope.
+        Args:
+            **fields: The fields of the scope, e.g., image and bands.
+        """
+        recorder, fields_outer = getattr(_scopes, "recorder", None), getattr(_scopes, "fields", {})
+        _scopes.recorder = self
+        _scopes.fields = dict(fields_outer if recorder is self else {}, **fields)
+        try:
+            yield self
+        finally:
+            _scopes.recorder, _scopes.fields = recorder, fields_outer
+
+    def complete(self, image, **fields):
+        """
+        Records an image as completed, and reports the progress if the interval has passed.
+        Args:
+            image (str): The name of the image.
+            **fields: The fields of the event, e.g., the position of the image.
+        """
+        self.completed += 1
+        self.record("image", image=image, **fields)
+        if time.time() - self.time_report >= self.interval:
+            self.report()
+
+    def report(self, **fields):
+        """
+        Records and prints the progress of the task, i.e., the images completed, the throughput, the estimated time left,
+        and the values of the gauges, e.g., the requests in flight and the images left in the queue.
+        Args:
+            **fields: The fields of the event.
+        """
+        for name, gauge in self.gauges.items():
+            fields.setdefault(name, gauge())
+        self.time_report = time.time()
+        elapsed = self.time_report - self.time_start
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.completed, 0)
+        eta = remaining / rate if rate > 0 else None
+        self.record("progress", completed=self.completed, total=self.total, elapsed=round(elapsed, 3),
+                    rate=round(rate, 4), eta=None if eta is None else round(eta, 1), **fields)
+        print(
+            f"{self.task or 'task'}: {self.completed:09d}/{self.total:09d} images in {elapsed:.0f} secs, "
+            f"{rate * 60:.1f} images/min, ETA {'unknown' if eta is None else f'{eta:.0f} secs'}"
+        )
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def record_event(event, **fields):
+    """
+    Records an event with the recorder of the current thread, if any, e.g., a retry deep in the download.
+    Args:
+        event (str): The name of the event.
+        **fields: The fields of the event.
+    """
+
+    recorder = getattr(_scopes, "recorder", None)
+    if recorder is not None:
+        recorder.record(event, **fields)
+
+
+def bind_scope(func):
+    """
+    Binds a function to the scope of the current thread, so that the events it records in other threads, e.g., the
+    threads downloading the tiles of a band, have the recorder and the fields of the scope.
+    Args:
+        func (callable): The function to bind.
+    Returns:
+        callable: The function running within the scope, or the same function if there is no scope.
+    """
+
+    recorder = getattr(_scopes, "recorder", None)
+    if recorder is None:
+        return func
+    fields = dict(_scopes.fields)
+
+    def bound(*args, **kwargs):
+        with recorder.scope(**fields):
+            return func(*args, **kwargs)
+    return bound
+
+
+@contextmanager
+def record_stage(stage, **fields):
+    """
+    Records the duration of a stage, e.g., 'transfer' or 'warp', with the recorder of the current thread, if any.
+    Args:
+        stage (str): The name of the stage.
+        **fields: The fields of the event.
+    Yields:
+        dict: The fields of the event, to which more can be added within the stage, e.g., the bytes transferred.
+    """
+
+    recorder = getattr(_scopes, "recorder", None)
+    start = time.perf_counter()
+    yield fields
+    if recorder is not None:
+        recorder.record("stage", stage=stage, duration=round(time.perf_counter() - start, 6), **fields)
+
+
+def aggregate_metrics(folderpath_metrics):
+    """
+    Aggregates the metrics files of all tasks of a run, i.e., the files '*.jsonl' in a folder.
+    Args:
+        folderpath_metrics (str): The folder of the metrics files.
+    Returns:
+        dict: The aggregated metrics, containing:
+            - stages (dict): The count, the total, mean and 95th percentile durations in seconds, and the bytes of each stage.
+            - tasks (dict): The images completed, the elapsed seconds and the images per minute of each task and process.
+            - retries (int): The number of retries.
+            - images (int): The number of images completed.
+    """
+
+    durations, nbytes, tasks = {}, {}, {}
+    retries = 0
+    for filepath in sorted(glob.glob(os.path.join(folderpath_metrics, "*.jsonl"))):
+        with open(filepath) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # a line cut by a killed task
+                if event["event"] == "stage":
+                    durations.setdefault(event["stage"], []).append(event["duration"])
+                    nbytes[event["stage"]] = nbytes.get(event["stage"], 0) + event.get("bytes", 0)
+                elif event["event"] == "retry":
+                    retries += 1
+                elif event["event"] in ("start", "image", "progress"):
+                    # a rerun of a task appends to the same file, but is another process
+                    task = tasks.setdefault(f'{event["task"]} ({event["host"]}:{event["pid"]})', {"images": 0, "time_start": event["time"], "time_end": event["time"]})
+                    task["images"] += event["event"] == "image"
+                    task["time_start"] = min(task["time_start"], event["time"])
+                    task["time_end"] = max(task["time_end"], event["time"])
+
+    stages = {}
+    for stage, values in durations.items():
+        values = sorted(values)
+        stages[stage] = {
+            "count": len(values),
+            "total": sum(values),
+            "mean": sum(values) / len(values),
+            "p95": values[min(len(values) - 1, int(0.95 * len(values)))],
+            "bytes": nbytes[stage],
+        }
+    for task in tasks.values():
+        task["elapsed"] = task["time_end"] - task["time_start"]
+        task["rate"] = task["images"] / task["elapsed"] * 60 if task["elapsed"] > 0 else 0.0
+    return {
+        "stages": stages,
+        "tasks": tasks,
+        "retries": retries,
+        "images": sum(task["images"] for task in tasks.values()),
+    }
@@ -0,0 +1,98 @@
+'''
+extract the time series of points from gee, sampled on the server without downloading rasters
+'''
+
+import json
+import ee
+from .utils import parse_hls_sensor, parse_gee_date, split_date_range
+from .scheduler import run_bounded
+from .session import call_with_retry
+from .constants import DOWNLOAD_RETRIES, GEE_ELEMENTS_MESSAGE
+
+def sample_points(collection, points, bands, resolution=30):
+    """
+    Samples the bands of all images of a collection at the points, with a single request to GEE.
+    Args:
+        collection (ee.ImageCollection): The filtered image collection.
+        points (list): The points as (id, lon, lat).
+        bands (list): The names of the bands to sample.
+        resolution (int, optional): The scale (in meters) of the sampling. Default is 30.
+    Returns:
+        list: The samples, each one a dictionary with 'point', 'scene', 'time' and the bands. Masked pixels are left out.
+    """
+
+    features = ee.FeatureCollection(
+        [ee.Feature(ee.Geometry.Point([lon, lat]), {"point": point}) for point, lon, lat in points]
+    )
+
+    def sample_image(image):
+        # tag the samples with the scene, and keep the needed properties only
+        return (
+            image.select(bands)
+            .sampleRegions(collection=features, properties=["point"], scale=resolution, geometries=False)
+            .map(lambda sample: sample.set("scene", image.get("system:index"), "time", image.get("system:time_start")))
+        )
+
+    samples = collection.map(sample_image).flatten()
+    return [feature["properties"] for feature in samples.getInfo()["features"]]
+
+def hls_points(points, date, bands="", sensor="L30", resolution=30, points_per_request=100, workers=1, retries=DOWNLOAD_RETRIES):
+    """
+    Extracts the time series of Harmonized Landsat and Sentinel-2 (HLS) data at points, sampled by GEE on the server,
+    so that no raster is downloaded. The points are split into groups, and the date range into months, to keep the samples
+    of each request, i.e., the points times the scenes, under the 5000 elements returned by GEE; a group still returning
+    more is split in halves. The requests are sent by a pool of threads and retried on transient errors.
+
+    Parameters:
+    points (list or str): The points as a list of (lon, lat), or as a string in the format of [[lon,lat],[lon,lat]].
+    date (str): The date range, in the format of 'YYYYMMDD-YYYYMMDD'.
+    bands (list, optional): The bands to sample. If empty, all bands of the sensor will be sampled.
+    sensor (str, optional): The sensor type, either "L30" for Landsat or "S30" for Sentinel-2. Default is "L30".
+    resolution (int, optional): The scale (in meters) of the sampling. Default is 30 meters.
+    points_per_request (int, optional): The maximum number of points sampled by one request. Default is 100.
+    workers (int, optional): The number of requests sent at the same time. Default is 1.
+    retries (int, optional): The maximum number of retries of a request failing with a transient error. Default is 5.
+
+    Returns:
+    pandas.DataFrame: One row per point and scene, with the columns 'point' (the position of the point in `points`),
+    'lon', 'lat', 'scene', 'time' and the bands, sorted by point and time. Pixels masked in a scene are left out.
+    """
+
+    import pandas as pd  # only required for the points
+
+    gee_hls_address, bands = parse_hls_sensor(sensor, bands)
+    if isinstance(points, str):
+        points = json.loads(points)
+    points = [(point, float(lon), float(lat)) for point, (lon, lat) in enumerate(points)]
+    date_start, date_end = parse_gee_date(date)
+
+    def iterate_requests():
+        for month_start, month_end in split_date_range(date_start, date_end, months = 1):
+            for first in range(0, len(points), points_per_request):
+                yield (month_start, month_end, points[first:first + points_per_request])
+
+    def run_request(month_start, month_end, points_group):
+        collection = (
+            ee.ImageCollection(gee_hls_address)
+            .filterDate(month_start, month_end)
+            .filterBounds(ee.Geometry.MultiPoint([[lon, lat] for _, lon, lat in points_group]))
+        )
+        try:
+            return call_with_retry(sample_points, collection, points_group, bands, resolution, retries = retries)
+        except ee.EEException as error:
+            # too many samples for one request, e.g., points on the overlaps of tiles seen by more scenes
+            if GEE_ELEMENTS_MESSAGE not in str(error) or len(points_group) == 1:
+                raise
+            half = len(points_group) // 2
+            return run_request(month_start, month_end, points_group[:half]) + run_request(month_start, month_end, points_group[half:])
+
+    samples = []
+    for _, result in run_bounded(run_request, iterate_requests(), workers = workers):
+        samples.extend(result)
+
+    table = pd.DataFrame(samples, columns=["point", "scene", "time"] + list(bands))
+    table["lon"] = table["point"].map({point: lon for point, lon, _ in points})
+    table["lat"] = table["point"].map({point: lat for point, _, lat in points})
+    table["time"] = pd.to_datetime(table["time"], unit="ms")
+    table = table[["point", "lon", "lat", "scene", "time"] + list(bands)]
+    return table.sort_values(["point", "time"]).reset_index(drop=True)
@@ -0,0 +1,166 @@
+'''
+run the download tasks in parallel, within a process by threads, and across processes by a shared queue
+'''
+
+import os
+import time
+import socket
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+def run_bounded(func, tasks, workers=1, queue_size=None):
+    """
+    Runs a function over the tasks with a pool of threads, keeping a bounded number of tasks in flight.
+    Tasks are pulled lazily from the iterable, so the memory stays flat no matter how many tasks there are.
+    Args:
+        func (callable): The function to run, called as func(*task).
+        tasks (iterable): The tasks, each one a tuple of the arguments of func.
+        workers (int, optional): The number of threads. With 1 worker, the tasks run one after another in the caller's thread. Default is 1.
+        queue_size (int, optional): The maximum number of tasks submitted but not yet finished. Default is twice the number of workers.
+    Yields:
+        tuple: The task and the result of func, in the order of completion.
+    Raises:
+        Exception: Any exception raised by func is raised again once the tasks in flight are finished.
+    """
+
+    if workers <= 1:
+        for task in tasks:
+            yield task, func(*task)
+        return
+
+    if queue_size is None:
+        queue_size = 2 * workers
+    tasks = iter(tasks)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while True:
+            # fill the queue up to its size
+            while len(pending) < queue_size:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending[executor.submit(func, *task)] = task
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                yield task, future.result()
+
+def _connect_queue(filepath_queue):
+    # autocommit mode, so that the transactions are managed explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(str(filepath_queue), timeout=600, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tasks (run TEXT, name TEXT, position INTEGER, status TEXT, owner TEXT, expiry REAL, "
+        "PRIMARY KEY (run, name))"
+    )
+    return conn
+
+def claim_tasks(filepath_queue, run, names, owner=None, lease=1800):
+    """
+    Claims the tasks one by one from a queue shared by all processes of a run, i.e., a SQLite ledger on the shared filesystem.
+    A claimed task is leased to its owner until it is completed or the lease expires, after which any process can claim it again,
+    so that the tasks of a process that died are taken over by the others.
+    Args:
+        filepath_queue (str): The path of the SQLite file of the queue, which is created if it does not exist.
+        run (str): The identifier of the run, shared by all of its processes.
+        names (list): The names of all tasks of the run, in the order to claim them. All processes must give the same tasks.
+        owner (str, optional): The identifier of this process. Default is the host name and the process ID.
+        lease (float, optional): The number of seconds a claim lasts without being renewed. Default is 1800.
+    Yields:
+        str: The name of the claimed task, which should be passed to complete_task once done.
+    """
+
+    if owner is None:
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+    with closing(_connect_queue(filepath_queue)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, 'pending', NULL, NULL)",
+            [(run, name, position) for position, name in enumerate(names)],
+        )
+        conn.execute("COMMIT")
+
+    while True:
+        with closing(_connect_queue(filepath_queue)) as conn:
+            # lock the ledger while looking for a pending or expired task and claiming it
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT name FROM tasks WHERE run = ? AND (status = 'pending' OR (status = 'claimed' AND expiry < ?)) "
+                "ORDER BY position LIMIT 1",
+                (run, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE tasks SET status = 'claimed', owner = ?, expiry = ? WHERE run = ? AND name = ?",
+                    (owner, now + lease, run, row[0]),
+                )
+            conn.execute("COMMIT")
+        if row is None:
+            return
+        yield row[0]
+
+def renew_task(filepath_queue, run, name, lease=1800):
+    """
+    Extends the lease of a claimed task, to keep it from being claimed by another process while it is still in progress.
+    Args:
+        filepath_queue (str): The path of the SQLite file of the queue.
+        run (str): The identifier of the run.
+        name (str): The name of the task.
+        lease (float, optional): The number of seconds the claim lasts from now. Default is 1800.
+    """
+
+    with closing(_connect_queue(filepath_queue)) as conn:
+        conn.execute(
+            "UPDATE tasks SET expiry = ? WHERE run = ? AND name = ? AND status = 'claimed'",
+            (time.time() + lease, run, name),
+        )
+
+def complete_task(filepath_queue, run, name):
+    """
+    Marks a claimed task as done, so that it is not claimed again within the run.
+    Args:
+        filepath_queue (str): The path of the SQLite file of the queue.
+        run (str): The identifier of the run.
+        name (str): The name of the task.
+    """
+
+    with closing(_connect_queue(filepath_queue)) as conn:
+        conn.execute(
+            "UPDATE tasks SET status = 'done', expiry = NULL WHERE run = ? AND name = ?",
+            (run, name),
+        )
+
+def count_tasks(filepath_queue, run, status="pending"):
+    """
+    Counts the tasks of a run in the shared queue by their status, e.g., the images left to be claimed.
+    Args:
+        filepath_queue (str): The path of the SQLite file of the queue.
+        run (str): The identifier of the run.
+        status (str, optional): The status of the tasks to count. Default is 'pending'.
+    Returns:
+        int: The number of tasks.
+    """
+
+    with closing(_connect_queue(filepath_queue)) as conn:
+        return conn.execute("SELECT COUNT(*) FROM tasks WHERE run = ? AND status = ?", (run, status)).fetchone()[0]
+
+def interleave_tasks(iterables):
+    """
+    Takes the tasks from several iterables in turn, e.g., one task of each job at a time, until all of them are exhausted.
+    Args:
+        iterables (list): The iterables of tasks, which are consumed lazily.
+    Yields:
+        object: The next task.
+    """
+
+    iterators = [iter(iterable) for iterable in iterables]
+    while iterators:
+        for iterator in list(iterators):
+            task = next(iterator, None)
+            if task is None:
+                iterators.remove(iterator)
+            else:
+                yield task
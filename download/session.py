@@ -0,0 +1,219 @@
+'''
+shared http session for downloading data from gee, with the retry and the rate control of the requests
+'''
+
+import io
+import time
+import random
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import ee
+from .constants import GEE_RETRY_MESSAGES
+from .metrics import record_event, record_stage
+
+# the session is shared by all threads of the process, so that keep-alive connections are reused
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+
+class IncompleteDownloadError(requests.RequestException):
+    """
+    Raised when the number of bytes received does not match the Content-Length of the response.
+    """
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of requests in flight, and adapts the limit by additive increase and multiplicative decrease (AIMD):
+    the limit grows by one for every `limit` successful requests, and is cut by `decrease` when a request is throttled,
+    e.g., by a 429 response or a timeout, so that the requests run as fast as the quota allows without manual tuning.
+    """
+
+    def __init__(self, limit, maximum, minimum=1, decrease=0.5):
+        """
+        Args:
+            limit (int): The initial number of requests in flight.
+            maximum (int): The maximum number of requests in flight, i.e., the number of workers.
+            minimum (int, optional): The minimum number of requests in flight. Default is 1.
+            decrease (float, optional): The factor to cut the limit by when a request is throttled. Default is 0.5.
+        """
+        self.limit = float(min(max(limit, minimum), maximum))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.inflight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Waits until the number of requests in flight is below the limit, and takes a slot.
+        """
+        with self._condition:
+            while self.inflight >= int(self.limit):
+                self._condition.wait()
+            self.inflight += 1
+
+    def release(self, throttled=False):
+        """
+        Gives back a slot, and adapts the limit according to the outcome of the request.
+        Args:
+            throttled (bool, optional): Whether the request was throttled. Default is False.
+        """
+        with self._condition:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+def get_session(pool_size=10):
+    """
+    Returns the process-wide requests session, creating it on first use.
+    Args:
+        pool_size (int, optional): The minimum number of pooled connections per host. Default is 10.
+            The session is recreated with a larger pool if more connections are requested than it holds.
+    Returns:
+        requests.Session: The shared session with keep-alive connections.
+    """
+
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None or _session_pool_size < pool_size:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            if _session is not None:
+                _session.close()
+            _session = session
+            _session_pool_size = pool_size
+        return _session
+
+
+def stream_to_file(response, filepath, chunk_size=1024 * 1024, checksum=None):
+    """
+    Writes the body of a streamed response to a file chunk by chunk, so that only one chunk is held in memory.
+    Args:
+        response (requests.Response): The response opened with stream=True.
+        filepath (str): The path of the file to write.
+        chunk_size (int, optional): The number of bytes read and written at a time. Default is 1 MiB.
+        checksum (str, optional): The name of a hashlib algorithm, e.g., 'md5' or 'sha256', to compute while writing. Default is None.
+    Raises:
+        IncompleteDownloadError: If the number of bytes written does not match the Content-Length of the response.
+    Returns:
+        tuple: A tuple containing:
+            - nbytes (int): The number of bytes written.
+            - digest (str): The hex digest of the content, or None if no checksum is requested.
+    """
+
+    with record_stage("transfer") as fields, open(filepath, "wb") as fd:
+        nbytes, digest = _copy_stream(response, fd, filepath, chunk_size, checksum)
+        fields["bytes"] = nbytes
+    return nbytes, digest
+
+
+def stream_to_memory(response, chunk_size=1024 * 1024, checksum=None):
+    """
+    Reads the body of a streamed response into memory chunk by chunk, checking its size as stream_to_file does.
+    Args:
+        response (requests.Response): The response opened with stream=True.
+        chunk_size (int, optional): The number of bytes read at a time. Default is 1 MiB.
+        checksum (str, optional): The name of a hashlib algorithm, e.g., 'md5' or 'sha256', to compute while reading. Default is None.
+    Raises:
+        IncompleteDownloadError: If the number of bytes read does not match the Content-Length of the response.
+    Returns:
+        tuple: A tuple containing:
+            - content (bytes): The content of the response.
+            - digest (str): The hex digest of the content, or None if no checksum is requested.
+    """
+
+    buffer = io.BytesIO()
+    with record_stage("transfer") as fields:
+        fields["bytes"], digest = _copy_stream(response, buffer, response.url, chunk_size, checksum)
+    return buffer.getvalue(), digest
+
+
+def _copy_stream(response, fd, name, chunk_size, checksum):
+    # copy the response to the file object, and check the length against the Content-Length
+    hasher = hashlib.new(checksum) if checksum else None
+    nbytes = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        fd.write(chunk)
+        nbytes += len(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+
+    # the length can only be checked when the content is not encoded, e.g., gzip, during the transfer
+    content_length = response.headers.get("Content-Length")
+    if content_length is not None and "Content-Encoding" not in response.headers:
+        if nbytes != int(content_length):
+            raise IncompleteDownloadError(f"Incomplete download of {name}: {nbytes} of {content_length} bytes received")
+    return nbytes, hasher.hexdigest() if hasher is not None else None
+
+
+def classify_error(error):
+    """
+    Tells whether an error of a download is transient and worth retrying, and whether it means the requests are throttled.
+    Args:
+        error (Exception): The error raised by the download.
+    Returns:
+        tuple: A tuple containing:
+            - retryable (bool): Whether the download should be retried.
+            - throttled (bool): Whether the requests should slow down, i.e., the quota or the server is overloaded.
+    """
+
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else None
+        if status_code in (429, 503):
+            return True, True
+        return status_code is not None and status_code >= 500, False
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True, True
+    if isinstance(error, requests.RequestException):
+        # e.g., incomplete or broken transfers
+        return True, False
+    if isinstance(error, ee.EEException):
+        message = str(error).lower()
+        retryable = any(text in message for text in GEE_RETRY_MESSAGES)
+        return retryable, retryable
+    return False, False
+
+
+def call_with_retry(func, *args, retries=5, backoff=2.0, backoff_max=120.0, limiter=None, **kwargs):
+    """
+    Calls a function, e.g., the download of a band, and retries it with jittered exponential backoff on transient errors.
+    Args:
+        func (callable): The function to call, as func(*args, **kwargs).
+        retries (int, optional): The maximum number of retries. Default is 5.
+        backoff (float, optional): The base of the backoff in seconds; the n-th retry waits a random time up to backoff * 2 ** (n - 1). Default is 2.
+        backoff_max (float, optional): The maximum backoff in seconds. Default is 120.
+        limiter (AdaptiveLimiter, optional): The limiter of the requests in flight, which is told the outcome of each call. Default is None.
+    Raises:
+        Exception: The error of the last attempt, or the first error that is not transient.
+    Returns:
+        object: The result of func.
+    """
+
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:  # pylint: disable=broad-except
+            retryable, throttled = classify_error(error)
+            if limiter is not None:
+                limiter.release(throttled=throttled)
+            if not retryable or attempt == retries:
+                raise
+            # full jitter, to spread the retries of the workers
+            delay = random.uniform(0, min(backoff_max, backoff * 2 ** attempt))
+            record_event("retry", attempt=attempt + 1, delay=round(delay, 3), throttled=throttled, error=str(error))
+            time.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.release()
+        return result
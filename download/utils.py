@@ -1,11 +1,24 @@
 import os
 import json
-import numpy as np
-import geopandas as gpd
-import ee
-from shapely.geometry import Polygon
-import rasterio
-from rasterio import warp
+import io
+import math
+import shutil
+import zipfile
+import functools
+import threading
+# numpy, rasterio and ee are imported by the functions using them, so that parsing the inputs, e.g., the roi, stays cheap
+from .metrics import record_stage
+from .constants import (
+    GEE_HLSL30_ADDRESS,
+    GEE_HLSS30_ADDRESS,
+    GEE_HLSL30_BANDS,
+    GEE_HLSS30_BANDS,
+    OUTPUT_FORMATS,
+    REQUEST_MAX_BYTES,
+)
+
+# the destination buffers of warp_image reused by each thread
+_warp_buffers = threading.local()
 
 def parse_gee_date(date):
     """
@@ -22,48 +35,92 @@ def parse_gee_date(date):
     
     return date_start, date_end
 
+def parse_hls_sensor(sensor, bands=""):
+    """
+    Gets the GEE collection of an HLS sensor, and its default bands if none are given.
+    Args:
+        sensor (str): The sensor type, either "L30" for Landsat or "S30" for Sentinel-2.
+        bands (list or str, optional): The bands to use. If empty, all bands of the sensor will be used.
+    Raises:
+        ValueError: If the sensor type is invalid.
+    Returns:
+        tuple: A tuple containing the address of the collection and the bands.
+    """
+
+    if sensor == "L30":
+        gee_hls_address = GEE_HLSL30_ADDRESS
+        if bands == "":
+            bands = GEE_HLSL30_BANDS
+    elif sensor == "S30":
+        gee_hls_address = GEE_HLSS30_ADDRESS
+        if bands == "":
+            bands = GEE_HLSS30_BANDS
+    else:
+        raise ValueError("Invalid sensor type. Please specify either 'L30' or 'S30'.")
+    return gee_hls_address, bands
+
+def split_date_range(date_start, date_end, months=12):
+    """
+    Splits a date range into the calendar periods it covers, e.g., the years or the months, to keep each request to GEE small.
+    Args:
+        date_start (str): The start date, in 'YYYY-MM-DD' format.
+        date_end (str): The end date, in 'YYYY-MM-DD' format.
+        months (int, optional): The number of months of a period, starting from January. Default is 12, i.e., years.
+    Returns:
+        list: The (start, end) dates of each period, in 'YYYY-MM-DD' format.
+    """
+
+    ranges = []
+    start = date_start
+    while start < date_end:
+        month = (int(start[5:7]) - 1) // months * months + months  # the months elapsed in the year at the next period
+        end = min(f"{int(start[:4]) + month // 12}-{month % 12 + 1:02d}-01", date_end)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
 def parse_gee_roi(roi):
     """
-    Parses a region of interest (ROI) string and returns a GeoDataFrame with the geometry and a bounding box string.
+    Parses a region of interest (ROI) string and returns its bounding box as a GEE geometry.
     Parameters:
     roi (str): The region of interest string. It can be in one of the following formats:
         - Format 1: A coordinate string in the format of [[[-90.93400996,32.85891488],[-90.82700534,32.85891488],[-90.82700534,32.94915305],[-90.93400996,32.94915305],[-90.93400996,32.85891488]]]
         - Format 2: A bounding box string in the format of [-121.68453831871847,40.034385959224565,-121.65922118033382,40.05761920014249]
         - Format 3: A path to a GeoJSON file ending with .json
+        - Format 4: A path to a GeoTIFF file ending with .tif, i.e., the reference layer
+    Raises:
+    ValueError: If the ROI is not in any of the formats.
     Returns:
-    tuple: A tuple containing:
-        - aoi_geom (GeoDataFrame): A GeoDataFrame containing the geometry of the ROI.
+    ee.Geometry: The bounding box of the ROI.
     """
 
-    # to get the geometry from the string, 
+    # to get the bounds from the string, without building the geometry, as only the bounding box is used
     # format 1 (copied from the PS explorer): [[[-90.93400996,32.85891488],[-90.82700534,32.85891488],[-90.82700534,32.94915305],[-90.93400996,32.94915305],[-90.93400996,32.85891488]]]
     if roi.startswith('[[['):
         # Assume it's a coordinate string and parse it
-        coordinates = json.loads(roi)
-        # Create GeoDataFrame with geometry
-        polygon = Polygon(coordinates[0])
-        aoi_geom = gpd.GeoDataFrame(geometry=[polygon], crs='EPSG:4326')
+        coordinates = json.loads(roi)[0]
+        minx, miny = min(x for x, _ in coordinates), min(y for _, y in coordinates)
+        maxx, maxy = max(x for x, _ in coordinates), max(y for _, y in coordinates)
     # format 2 (GEE format, minx, miny, maxx, maxy): [-121.68453831871847,40.034385959224565,-121.65922118033382,40.05761920014249]
     elif roi.startswith('['):
         # Assume it's a bounding box and parse it
-        minx, miny, maxx, maxy = json.loads(roi)
-        # Create the polygon using the bounding box coordinates
-        polygon = Polygon([
-            (minx, miny),
-            (minx, maxy),
-            (maxx, maxy),
-            (maxx, miny),
-            (minx, miny)  # Close the polygon by repeating the first point
-        ])
-
-        # polygon = Polygon([[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]])
-        aoi_geom = gpd.GeoDataFrame(geometry=[polygon], crs='EPSG:4326')
+        x1, y1, x2, y2 = json.loads(roi)
+        minx, miny, maxx, maxy = min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
     # format 3 (geojson file)
     elif roi.endswith('.json'):
-        aoi_geom = gpd.read_file(roi)
-    
-    roi_coords  = aoi_geom.geometry.total_bounds
-    roi_gee     = ee.Geometry.BBox(roi_coords[0], roi_coords[1], roi_coords[2], roi_coords[3])
+        import geopandas as gpd  # only required for the GeoJSON files, and slow to import
+        minx, miny, maxx, maxy = gpd.read_file(roi).geometry.total_bounds
+    # format 4 (the reference layer as a geotiff file)
+    elif roi.endswith('.tif'):
+        import rasterio
+        from rasterio import warp
+        with rasterio.open(roi) as src:
+            minx, miny, maxx, maxy = warp.transform_bounds(src.crs, 'EPSG:4326', *src.bounds, densify_pts=21)
+    else:
+        raise ValueError("Invalid ROI. Please specify a polygon [[[x, y], ...]], a bounding box [minx, miny, maxx, maxy], a .json file or a .tif file.")
+
+    import ee
+    roi_gee     = ee.Geometry.BBox(float(minx), float(miny), float(maxx), float(maxy))
     
     return roi_gee
 
@@ -93,7 +150,7 @@ def parse_reference_name(name = 'reference_layer', ci = 1, cn = 1):
     else:
         return f'{name}_{ci:09d}_{cn:09d}.tif'
 
-def filter_missing_bands(image_folder, image_name, bands):
+def filter_missing_bands(image_folder, image_name, bands, completed=None):
     """
     Identifies bands that are missing in the specified image folder.
 
@@ -101,10 +158,15 @@ def filter_missing_bands(image_folder, image_name, bands):
         image_folder (str): Path to the folder where images are stored.
         image_name (str): Name of the image being processed.
         bands (list): List of band names to check.
+        completed (dict, optional): The file names of the completed bands, e.g., from the ledger. If given, the folder is not checked.
 
     Returns:
         list: List of bands that do not exist in the image folder.
     """
+    # check against the completed bands, without touching the file system
+    if completed is not None:
+        return [band for band in bands if parse_band_name(image_name, band) not in completed]
+
     # If the image folder does not exist, create it and return all bands
     if not os.path.exists(image_folder):
         return bands
@@ -118,23 +180,115 @@ def filter_missing_bands(image_folder, image_name, bands):
 
         return missing_bands
 
+def extract_zipped_bands(filepath_zip, bands, filepath_bands):
+    """
+    Extracts the per-band GeoTIFFs from a zip file downloaded from GEE.
+    Args:
+        filepath_zip (str): The path to the zip file, which contains one GeoTIFF per band named as '<name>.<band>.tif'.
+        bands (list): The names of the bands to extract.
+        filepath_bands (list): The destination file paths, in the same order as `bands`.
+    Raises:
+        KeyError: If a band is not found in the zip file.
+    Returns:
+        list: The file paths of the extracted bands.
+    """
+
+    with zipfile.ZipFile(filepath_zip) as zf:
+        members = zf.namelist()
+        for band, filepath_band in zip(bands, filepath_bands):
+            # the member is named as <name>.<band>.tif by GEE
+            member = next((m for m in members if m.endswith(f".{band}.tif")), None)
+            if member is None:
+                raise KeyError(f"Band {band} is not found in {filepath_zip}")
+            with zf.open(member) as src, open(filepath_band, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+    return filepath_bands
+
+def read_zipped_images(content, bands):
+    """
+    Reads the per-band GeoTIFFs of a zip file downloaded from GEE, without writing them to disk.
+    Args:
+        content (bytes): The content of the zip file, which contains one GeoTIFF per band named as '<name>.<band>.tif'.
+        bands (list): The names of the bands to read.
+    Raises:
+        KeyError: If a band is not found in the zip file.
+    Returns:
+        list: The (data, profile) of each band, in the same order as `bands`.
+    """
+
+    images = []
+    with zipfile.ZipFile(io.BytesIO(content)) as zf:
+        members = zf.namelist()
+        for band in bands:
+            # the member is named as <name>.<band>.tif by GEE
+            member = next((m for m in members if m.endswith(f".{band}.tif")), None)
+            if member is None:
+                raise KeyError(f"Band {band} is not found in the zip file")
+            images.append(read_image(zf.read(member)))
+    return images
+
 def read_image(filepath):
     """
     Reads an image from the specified file path using rasterio and returns the image data and its profile.
     Args:
-        filepath (str): The path to the image file to be read.
+        filepath (str or bytes): The path to the image file to be read, or the content of the image file in memory.
     Returns:
         tuple: A tuple containing:
             - data (numpy.ndarray): The image data read from the file.
             - profile (dict): The profile metadata of the image.
     """
     
+    import rasterio
+    from rasterio.io import MemoryFile
+
+    # decode the image straight from memory
+    if isinstance(filepath, (bytes, bytearray)):
+        with record_stage("read", bytes=len(filepath)), MemoryFile(filepath) as memfile, memfile.open() as src:
+            profile = src.profile
+            data = src.read(1)
+        return data, profile
+
     # read the profile of the downloaded image
-    with rasterio.open(filepath) as src:
+    with record_stage("read"), rasterio.open(filepath) as src:
         profile = src.profile
         data = src.read(1)
     return data, profile
 
+def get_output_profile(profile, output_format='gtiff'):
+    """
+    Sets the creation options of an output format on a profile, i.e., the compression, the internal tiling and the layout.
+    Args:
+        profile (dict): The profile metadata of the image, i.e., of the reference layer.
+        output_format (str, optional): One of 'gtiff' (the profile as it is), 'deflate', 'zstd' or 'cog'. Default is 'gtiff'.
+    Returns:
+        dict: The profile with the creation options.
+    """
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output format. Please choose from: {', '.join(OUTPUT_FORMATS)}")
+    if output_format == 'gtiff':
+        return profile
+    profile = profile.copy()
+    # drop the layout inherited from the reference layer
+    for key in ('tiled', 'blockxsize', 'blockysize', 'compress', 'interleave', 'predictor'):
+        profile.pop(key, None)
+    profile.update(OUTPUT_FORMATS[output_format])
+    return profile
+
+def set_predictor(profile):
+    """
+    Sets the predictor of a compressed profile by its data type, i.e., horizontal differencing for integers and floating point prediction for floats.
+    Args:
+        profile (dict): The profile metadata of the image.
+    Returns:
+        dict: The profile with the predictor, or the same profile if it is not compressed.
+    """
+
+    if profile.get('compress') is None or 'predictor' in profile:
+        return profile
+    import numpy as np
+    return dict(profile, predictor=3 if np.dtype(profile['dtype']).kind == 'f' else 2)
+
 def save_image(filepath, data, profile):
     """
     Saves an image to the specified file path using rasterio.
@@ -144,21 +298,106 @@ def save_image(filepath, data, profile):
         profile (dict): The profile metadata of the image.
     """
     
-    # save the image
-    with rasterio.open(filepath, 'w', **profile) as dst:
+    import rasterio
+
+    # save the image, compressed by all cores if the profile has the creation options of an output format
+    with record_stage("save"), rasterio.open(filepath, 'w', **set_predictor(profile)) as dst:
         dst.write(data, 1)       
     
+def get_utm_crs(system_index):
+    """
+    Gets the UTM CRS of an HLS scene from the MGRS tile in its name.
+    Args:
+        system_index (str): The index of the scene, i.e., T18SUH_20200112T154027, where 18 is the UTM zone and S is the latitude band.
+    Returns:
+        str: The CRS as an EPSG code, i.e., 'EPSG:32618'.
+    """
+
+    zone = int(system_index[1:3])
+    # the latitude bands from N to X are in the northern hemisphere
+    if system_index[3].upper() >= 'N':
+        return f'EPSG:{32600 + zone}'
+    return f'EPSG:{32700 + zone}'
+
+def get_roi_bounds(roi_gee):
+    """
+    Gets the bounds of a region of interest locally, without a request to GEE.
+    Args:
+        roi_gee (ee.Geometry): The region of interest, as created by parse_gee_roi.
+    Returns:
+        tuple: The bounds (minx, miny, maxx, maxy) in EPSG:4326.
+    """
+
+    coordinates = roi_gee.toGeoJSON()['coordinates'][0]
+    return (
+        min(x for x, _ in coordinates), min(y for _, y in coordinates),
+        max(x for x, _ in coordinates), max(y for _, y in coordinates),
+    )
+
+def create_reference_profile(filepath_reference, bounds, resolution, crs):
+    """
+    Creates the reference profile from the bounds of the ROI, the resolution and the CRS, and saves it as a small JSON sidecar
+    shared by all parallel processes. The grid is snapped to multiples of the resolution, as the HLS grid is.
+    Args:
+        filepath_reference (str): The path of the JSON file to save the profile.
+        bounds (tuple): The bounds (minx, miny, maxx, maxy) of the ROI in EPSG:4326.
+        resolution (int): The resolution (in meters) of the grid.
+        crs (str): The CRS of the grid, i.e., 'EPSG:32618'.
+    Returns:
+        str: The path of the JSON file.
+    """
+
+    from rasterio import warp
+
+    # the bounds in the target crs, densified along the edges
+    left, bottom, right, top = warp.transform_bounds('EPSG:4326', crs, *bounds, densify_pts=21)
+    left = math.floor(left / resolution) * resolution
+    top = math.ceil(top / resolution) * resolution
+    width = int(math.ceil((right - left) / resolution))
+    height = int(math.ceil((top - bottom) / resolution))
+    reference = {
+        'crs': crs,
+        'transform': [resolution, 0.0, float(left), 0.0, -resolution, float(top)],
+        'width': width,
+        'height': height,
+    }
+    # write to a temporary file first, as other processes may be creating the same one
+    filepath_temp = f'{filepath_reference}.{os.getpid()}.part'
+    with open(filepath_temp, 'w') as f:
+        json.dump(reference, f)
+    os.replace(filepath_temp, filepath_reference)
+    return filepath_reference
+
 def get_reference_profile(filepath_reference):
     """
     Reads a GeoTIFF file and extracts its Coordinate Reference System (CRS) and affine transformation matrix.
     Args:
-        filepath_reference (str): The file path to the reference GeoTIFF file.
+        filepath_reference (str): The file path to the reference GeoTIFF file, or to the JSON file created by create_reference_profile.
     Returns:
         tuple: A tuple containing:
             - crs (str): The CRS in Well-Known Text (WKT) format.
             - crs_transformer (list): The affine transformation matrix as a list of six elements.
     """
     
+    import rasterio
+    import rasterio.crs
+
+    # read the JSON sidecar, and make up the profile of a single band GeoTIFF
+    if str(filepath_reference).endswith('.json'):
+        with open(filepath_reference) as f:
+            reference = json.load(f)
+        profile = {
+            'driver': 'GTiff',
+            'dtype': 'int16',
+            'nodata': None,
+            'count': 1,
+            'crs': rasterio.crs.CRS.from_user_input(reference['crs']),
+            'transform': rasterio.Affine(*reference['transform']),
+            'width': reference['width'],
+            'height': reference['height'],
+        }
+        return profile, profile['crs'].to_wkt(), reference['transform']
+
     # read the GeoTIFF to get the CRS and transform information
     with rasterio.open(filepath_reference) as src:
         # get the profile
@@ -171,7 +410,85 @@ def get_reference_profile(filepath_reference):
     return profile, crs, crs_transformer
 
 
-def warp_image(image, imageprofile, likeprofile, resampling=rasterio.warp.Resampling.nearest):
+def fit_tile_size(tile_size, nbands):
+    """
+    Fits the tile size to the number of bands of a request, so that the pixels of a tile stay under the request size limit of GEE.
+    Args:
+        tile_size (int): The maximum number of rows and columns of a tile.
+        nbands (int): The number of bands requested at once.
+    Returns:
+        int: The tile size, for up to 8 bytes per pixel and band.
+    """
+
+    return min(tile_size, int((REQUEST_MAX_BYTES / (8 * nbands)) ** 0.5))
+
+def split_tiles(width, height, tile_size):
+    """
+    Splits a grid into tiles of at most tile_size rows and columns.
+    Args:
+        width (int): The number of columns of the grid.
+        height (int): The number of rows of the grid.
+        tile_size (int): The maximum number of rows and columns of a tile.
+    Returns:
+        list: The windows of the tiles as (row_off, col_off, height, width).
+    """
+
+    return [
+        (row_off, col_off, min(tile_size, height - row_off), min(tile_size, width - col_off))
+        for row_off in range(0, height, tile_size)
+        for col_off in range(0, width, tile_size)
+    ]
+
+def get_warp_buffer(likeprofile, dtype):
+    """
+    Returns a destination array for warp_image that is reused by the calling thread, instead of allocating one per band.
+    Args:
+        likeprofile (dict): The target profile, containing width and height.
+        dtype (str): The data type of the array.
+    Returns:
+        numpy.ndarray: The array with the shape of the target profile.
+    """
+
+    import numpy as np
+
+    if not hasattr(_warp_buffers, 'arrays'):
+        _warp_buffers.arrays = {}
+    key = (likeprofile['height'], likeprofile['width'], np.dtype(dtype).str)
+    if key not in _warp_buffers.arrays:
+        _warp_buffers.arrays[key] = np.zeros((likeprofile['height'], likeprofile['width']), dtype=dtype)
+    return _warp_buffers.arrays[key]
+
+@functools.lru_cache(maxsize=64)
+def get_grid_offset(src_crs, src_transform, dst_crs, dst_transform, tolerance=1e-6):
+    """
+    Checks whether a source grid lines up with a target grid, and returns the pixel offset between them.
+    The result is cached, since all bands of a scene, and usually all scenes, share the same grids.
+    Args:
+        src_crs (rasterio.crs.CRS): The CRS of the source grid.
+        src_transform (affine.Affine): The affine transform of the source grid.
+        dst_crs (rasterio.crs.CRS): The CRS of the target grid.
+        dst_transform (affine.Affine): The affine transform of the target grid.
+        tolerance (float, optional): The tolerance in pixels to accept the offsets as integers. Default is 1e-6.
+    Returns:
+        tuple: The (row, col) of the first source pixel on the target grid, or None if the grids are not aligned.
+    """
+
+    if src_crs != dst_crs:
+        return None
+    # same pixel size and no rotation
+    pixel = abs(dst_transform.a)
+    for src_coef, dst_coef in ((src_transform.a, dst_transform.a), (src_transform.b, dst_transform.b),
+                               (src_transform.d, dst_transform.d), (src_transform.e, dst_transform.e)):
+        if abs(src_coef - dst_coef) > tolerance * pixel:
+            return None
+    # integer offsets of the origin
+    col = (src_transform.c - dst_transform.c) / dst_transform.a
+    row = (src_transform.f - dst_transform.f) / dst_transform.e
+    if abs(col - round(col)) > tolerance or abs(row - round(row)) > tolerance:
+        return None
+    return int(round(row)), int(round(col))
+
+def warp_image(image, imageprofile, likeprofile, resampling=None, destination=None):
     """
     Warps an image array to match the CRS, transform, width, and height of a target profile.
     
@@ -179,32 +496,58 @@ def warp_image(image, imageprofile, likeprofile, resampling=rasterio.warp.Resamp
         image (numpy.ndarray): The input image array (shape: [bands, height, width]).
         imageprofile (dict): The profile of the input image, containing CRS, transform, etc.
         likeprofile (dict): The target profile, containing CRS, transform, width, and height.
+        resampling (rasterio.enums.Resampling, optional): The resampling method. Default is None for the nearest neighbor.
+        destination (numpy.ndarray, optional): The array to write the warped image into, which is overwritten.
+            It must have the shape of the target profile and the data type of the input image. Default is None to allocate a new one.
     
     Returns:
         numpy.ndarray: The warped image array (shape: [bands, target_height, target_width]).
     """
     
+    import numpy as np
+    from rasterio import warp
+
     # update the updated profile
     desprofile = likeprofile.copy()
     desprofile['dtype'] = imageprofile['dtype']
     desprofile['nodata'] = imageprofile['nodata']
     
-    # Create an empty array to store the warped image
-    warped_image = np.zeros(
-        (likeprofile['height'], likeprofile['width']),
-        dtype=desprofile['dtype'] # do not change the orginal data type
-    )
+    # Create an empty array to store the warped image, filled as nodata where the input image does not cover
+    fill_value = 0 if desprofile['nodata'] is None else desprofile['nodata']
+    if destination is None:
+        warped_image = np.full(
+            (likeprofile['height'], likeprofile['width']),
+            fill_value,
+            dtype=desprofile['dtype'] # do not change the orginal data type
+        )
+    else:
+        warped_image = destination
+        warped_image.fill(fill_value)
+
+    # the input image is already on the target grid, i.e., reprojected by GEE, copy the overlapping window only
+    offset = get_grid_offset(imageprofile['crs'], imageprofile['transform'], desprofile['crs'], desprofile['transform'])
+    if offset is not None:
+        with record_stage("warp", aligned=True):
+            row, col = offset
+            row_start, row_end = max(row, 0), min(row + image.shape[0], warped_image.shape[0])
+            col_start, col_end = max(col, 0), min(col + image.shape[1], warped_image.shape[1])
+            if row_start < row_end and col_start < col_end:
+                warped_image[row_start:row_end, col_start:col_end] = image[
+                    row_start - row:row_end - row, col_start - col:col_end - col
+                ]
+        return warped_image, desprofile
     
     # Warp each band of the input image
-    warp.reproject(
-        source=image,  # Source band
-        destination=warped_image,  # Destination band
-        src_transform=imageprofile['transform'],  # Source affine transform
-        src_crs=imageprofile['crs'],  # Source CRS
-        dst_transform=desprofile['transform'],  # Target affine transform
-        dst_crs=desprofile['crs'],  # Target CRS
-        resampling=resampling,  # Resampling method
-        dst_nodata=desprofile['nodata']   # do not change it
-        )
+    with record_stage("warp", aligned=False):
+        warp.reproject(
+            source=image,  # Source band
+            destination=warped_image,  # Destination band
+            src_transform=imageprofile['transform'],  # Source affine transform
+            src_crs=imageprofile['crs'],  # Source CRS
+            dst_transform=desprofile['transform'],  # Target affine transform
+            dst_crs=desprofile['crs'],  # Target CRS
+            resampling=warp.Resampling.nearest if resampling is None else resampling,  # Resampling method
+            dst_nodata=desprofile['nodata']   # do not change it
+            )
 
     return warped_image, desprofile
\ No newline at end of file
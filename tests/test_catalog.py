@@ -0,0 +1,34 @@
+'''
+tests of the scenes grouped by date to be mosaicked
+'''
+
+from download.catalog import get_screening_key, group_scenes
+
+DAY = 24 * 3600 * 1000
+
+
+def make_scene(index, time_start, cloud_coverage):
+    return {"system:index": index, "system:time_start": time_start, "CLOUD_COVERAGE": cloud_coverage}
+
+
+def test_group_scenes_orders_dates_and_mosaics():
+    start = 1578787200000  # 2020-01-12T00:00:00Z
+    scenes = [
+        make_scene("L30_T18SVH_20200113", start + DAY + 600, 10),
+        make_scene("L30_T18SUH_20200112", start + 500, 40),
+        make_scene("L30_T18SVH_20200112", start + 400, 5),
+        make_scene("L30_T18TUJ_20200112", start + 300, None),
+    ]
+    mosaics = group_scenes(scenes)
+    assert [mosaic["date"] for mosaic in mosaics] == ["20200112", "20200113"]
+
+    # the clearest scene is last, on top of the mosaic, and gives its properties
+    mosaic = mosaics[0]
+    assert mosaic["scenes"] == ["L30_T18SUH_20200112", "L30_T18SVH_20200112", "L30_T18TUJ_20200112"]
+    assert mosaic["system:index"] == "L30_T18TUJ_20200112"
+    assert mosaic["system:time_start"] == start + 300
+    assert get_screening_key(mosaic) == "L30_T18SUH_20200112+L30_T18SVH_20200112+L30_T18TUJ_20200112"
+
+    assert mosaics[1]["scenes"] == ["L30_T18SVH_20200113"]
+    assert get_screening_key(scenes[0]) == "L30_T18SVH_20200113"
+    assert "scenes" not in scenes[1]
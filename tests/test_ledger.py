@@ -0,0 +1,37 @@
+'''
+tests of the ledger of the completed band images
+'''
+
+import hashlib
+import os
+from download.ledger import append_ledger, describe_band, load_ledger, read_ledger
+
+
+def test_load_ledger_starts_from_the_band_files(tmp_path):
+    folderpath_image = tmp_path / "HLS" / "L30_T18SUH_20200112T154027"
+    folderpath_image.mkdir(parents = True)
+    (folderpath_image / "L30_T18SUH_20200112T154027_B4.tif").write_bytes(b"band")
+    (folderpath_image / "L30_T18SUH_20200112T154027_B5.part.tif").write_bytes(b"partial")
+    filepath_ledger = str(tmp_path / "ledger.jsonl")
+
+    records = load_ledger(filepath_ledger, str(tmp_path / "HLS"))
+    assert list(records) == ["L30_T18SUH_20200112T154027_B4.tif"]
+    assert sorted(os.listdir(tmp_path)) == ["HLS", "ledger.jsonl"]
+
+    # the existing ledger is read as it is, without scanning the band files again
+    (folderpath_image / "L30_T18SUH_20200112T154027_B5.tif").write_bytes(b"band")
+    assert list(load_ledger(filepath_ledger, str(tmp_path / "HLS"))) == ["L30_T18SUH_20200112T154027_B4.tif"]
+
+
+def test_ledger_records_the_size_and_the_checksum_on_request(tmp_path):
+    filepath_band = tmp_path / "L30_T18SUH_20200112T154027_B4.tif"
+    filepath_band.write_bytes(b"band")
+    assert describe_band(str(filepath_band)) == {"file": filepath_band.name, "size": 4, "md5": None}
+    record = describe_band(str(filepath_band), checksum = True)
+    assert record["md5"] == hashlib.md5(b"band").hexdigest()
+
+    filepath_ledger = str(tmp_path / "ledger.jsonl")
+    append_ledger(filepath_ledger, [record])
+    with open(filepath_ledger, "a") as f:
+        f.write('{"file": "cut')  # a line cut off by a process that died
+    assert read_ledger(filepath_ledger) == {filepath_band.name: record}
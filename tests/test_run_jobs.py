@@ -0,0 +1,37 @@
+'''
+regression tests of running the tasks of several jobs in one pool
+'''
+
+from contextlib import nullcontext
+from download.download import run_jobs
+from download.metrics import MetricsRecorder
+from download.scheduler import interleave_tasks
+
+
+def make_job(name, tasks, completed):
+    return {
+        "tasks": iter(tasks),
+        "run_task": lambda task, retries, limiter: (name, task),
+        "complete": lambda task, result: completed.append((name, task, result)),
+        "finish": lambda: completed.append((name, "finish", None)),
+        "scope": lambda task: nullcontext(),
+        "metrics": MetricsRecorder(),
+    }
+
+
+def test_interleave_tasks_keeps_jobs():
+    jobs = [("a", [1, 2]), ("b", [3, 4])]
+
+    def job_tasks(job):
+        return ((job[0], task) for task in job[1])
+
+    assert list(interleave_tasks([job_tasks(job) for job in jobs])) == [("a", 1), ("b", 3), ("a", 2), ("b", 4)]
+
+
+def test_run_jobs_pairs_tasks_with_their_jobs():
+    for workers in (1, 3):
+        completed = []
+        run_jobs([make_job("a", [(1,), (2,)], completed), make_job("b", [(3,), (4,)], completed)], workers = workers)
+        results = sorted(entry for entry in completed if entry[1] != "finish")
+        assert results == [("a", (1,), ("a", 1)), ("a", (2,), ("a", 2)), ("b", (3,), ("b", 3)), ("b", (4,), ("b", 4))]
+        assert sorted(entry[0] for entry in completed if entry[1] == "finish") == ["a", "b"]
@@ -0,0 +1,43 @@
+'''
+tests of the queue shared by the processes of a run
+'''
+
+import time
+from download.scheduler import claim_tasks, complete_task, count_tasks, renew_task
+
+
+def test_claim_tasks_once_each(tmp_path):
+    filepath_queue = tmp_path / "queue.sqlite"
+    names = ["a", "b", "c"]
+    first = claim_tasks(filepath_queue, "run", names, owner = "first")
+    second = claim_tasks(filepath_queue, "run", names, owner = "second")
+    assert next(first) == "a"
+    assert next(second) == "b"
+    assert next(first) == "c"
+    assert next(second, None) is None
+    assert count_tasks(filepath_queue, "run", "claimed") == 3
+
+
+def test_claim_tasks_reclaims_expired_leases(tmp_path):
+    filepath_queue = tmp_path / "queue.sqlite"
+    names = ["a", "b"]
+    # a process that dies holding a task with a short lease
+    dead = claim_tasks(filepath_queue, "run", names, owner = "dead", lease = 0.2)
+    assert next(dead) == "a"
+    alive = claim_tasks(filepath_queue, "run", names, owner = "alive", lease = 60)
+    assert next(alive) == "b"
+    renew_task(filepath_queue, "run", "b", lease = 60)
+    complete_task(filepath_queue, "run", "b")
+    time.sleep(0.3)
+    # the expired task is claimed again, but not the completed one
+    assert next(alive) == "a"
+    assert next(alive, None) is None
+    assert count_tasks(filepath_queue, "run", "done") == 1
+
+
+def test_claim_tasks_separates_runs(tmp_path):
+    filepath_queue = tmp_path / "queue.sqlite"
+    earlier = claim_tasks(filepath_queue, "earlier", ["a"])
+    assert next(earlier) == "a"
+    complete_task(filepath_queue, "earlier", "a")
+    assert list(claim_tasks(filepath_queue, "later", ["a"])) == ["a"]
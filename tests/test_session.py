@@ -0,0 +1,106 @@
+'''
+tests of the classification of the download errors, the adaptive limiter of the requests in flight and the streams
+'''
+
+import hashlib
+import ee
+import pytest
+import requests
+from download.session import AdaptiveLimiter, IncompleteDownloadError, call_with_retry, classify_error, stream_to_file, stream_to_memory
+
+
+def make_http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"{status_code} error", response=response)
+
+
+class FakeResponse:
+    def __init__(self, chunks, headers=None):
+        self.chunks = chunks
+        self.headers = headers if headers is not None else {"Content-Length": str(sum(len(chunk) for chunk in chunks))}
+        self.url = "http://localhost/band.tif"
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+
+
+def test_classify_error():
+    assert classify_error(make_http_error(429)) == (True, True)
+    assert classify_error(make_http_error(503)) == (True, True)
+    assert classify_error(make_http_error(500)) == (True, False)
+    assert classify_error(make_http_error(400)) == (False, False)
+    assert classify_error(requests.ConnectionError("reset")) == (True, True)
+    assert classify_error(IncompleteDownloadError("cut")) == (True, False)
+    assert classify_error(ee.EEException("Too many concurrent aggregations.")) == (True, True)
+    assert classify_error(ee.EEException("Image.select: Pattern 'B99' did not match any bands.")) == (False, False)
+    assert classify_error(ValueError("bug")) == (False, False)
+
+
+def test_adaptive_limiter_increases_and_decreases():
+    limiter = AdaptiveLimiter(2, maximum = 4)
+    for _ in range(2):
+        limiter.acquire()
+    assert limiter.inflight == 2
+    limiter.release()
+    limiter.release()
+    # one more slot for every `limit` successful requests
+    assert limiter.limit == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+    limiter.acquire()
+    limiter.release(throttled = True)
+    assert limiter.limit == pytest.approx((2 + 1 / 2 + 1 / 2.5) / 2)
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release(throttled = True)
+    assert limiter.limit == 1
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 4
+    assert limiter.inflight == 0
+
+
+def test_call_with_retry_retries_transient_errors_only():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise make_http_error(503)
+        return "done"
+
+    limiter = AdaptiveLimiter(2, maximum = 2)
+    assert call_with_retry(flaky, retries = 5, backoff = 0, limiter = limiter) == "done"
+    assert len(attempts) == 3
+    assert limiter.inflight == 0
+
+    def invalid():
+        attempts.append(1)
+        raise make_http_error(400)
+
+    attempts.clear()
+    with pytest.raises(requests.HTTPError):
+        call_with_retry(invalid, retries = 5, backoff = 0)
+    assert len(attempts) == 1
+
+    attempts.clear()
+    with pytest.raises(requests.HTTPError):
+        call_with_retry(flaky, retries = 0, backoff = 0)
+    assert len(attempts) == 1
+
+
+def test_streams_compute_the_checksum(tmp_path):
+    chunks = [b"abc", b"def"]
+    filepath = str(tmp_path / "band.tif")
+    assert stream_to_file(FakeResponse(chunks), filepath, checksum = "md5") == (6, hashlib.md5(b"abcdef").hexdigest())
+    assert stream_to_file(FakeResponse(chunks), filepath) == (6, None)
+    with open(filepath, "rb") as f:
+        assert f.read() == b"abcdef"
+    assert stream_to_memory(FakeResponse(chunks), checksum = "sha256") == (b"abcdef", hashlib.sha256(b"abcdef").hexdigest())
+
+
+def test_streams_check_the_content_length(tmp_path):
+    with pytest.raises(IncompleteDownloadError):
+        stream_to_memory(FakeResponse([b"abc"], headers = {"Content-Length": "6"}))
+    # the length of an encoded transfer is not comparable
+    assert stream_to_memory(FakeResponse([b"abc"], headers = {"Content-Length": "6", "Content-Encoding": "gzip"}))[0] == b"abc"
@@ -0,0 +1,74 @@
+'''
+tests of the helpers of the requests and of the band images
+'''
+
+import numpy as np
+from affine import Affine
+from rasterio import warp
+from rasterio.crs import CRS
+from download.constants import REQUEST_MAX_BYTES
+from download.utils import fit_tile_size, split_date_range, split_tiles, warp_image
+
+
+def test_fit_tile_size_stays_under_the_request_limit():
+    assert fit_tile_size(256, 1) == 256
+    for nbands in (1, 4, 16, 64):
+        tile_size = fit_tile_size(4096, nbands)
+        assert tile_size ** 2 * nbands * 8 <= REQUEST_MAX_BYTES
+        assert (tile_size + 1) ** 2 * nbands * 8 > REQUEST_MAX_BYTES
+
+
+def test_split_tiles_covers_the_grid_once():
+    tiles = split_tiles(250, 120, 100)
+    assert tiles == [
+        (0, 0, 100, 100), (0, 100, 100, 100), (0, 200, 100, 50),
+        (100, 0, 20, 100), (100, 100, 20, 100), (100, 200, 20, 50),
+    ]
+    assert sum(height * width for _, _, height, width in tiles) == 250 * 120
+    assert split_tiles(100, 100, 100) == [(0, 0, 100, 100)]
+
+
+def test_split_date_range_by_calendar_periods():
+    assert split_date_range("2020-03-15", "2022-02-01") == [
+        ("2020-03-15", "2021-01-01"), ("2021-01-01", "2022-01-01"), ("2022-01-01", "2022-02-01"),
+    ]
+    assert split_date_range("2020-11-20", "2021-02-10", months = 1) == [
+        ("2020-11-20", "2020-12-01"), ("2020-12-01", "2021-01-01"),
+        ("2021-01-01", "2021-02-01"), ("2021-02-01", "2021-02-10"),
+    ]
+    assert split_date_range("2020-01-01", "2020-01-01") == []
+
+
+def make_profile(transform, width, height, crs = "EPSG:32618"):
+    return {"crs": CRS.from_string(crs), "transform": transform, "width": width, "height": height,
+            "dtype": "int16", "nodata": -9999}
+
+
+def reproject_image(image, imageprofile, likeprofile):
+    warped = np.full((likeprofile["height"], likeprofile["width"]), imageprofile["nodata"], dtype = image.dtype)
+    warp.reproject(source = image, destination = warped,
+                   src_transform = imageprofile["transform"], src_crs = imageprofile["crs"],
+                   dst_transform = likeprofile["transform"], dst_crs = likeprofile["crs"],
+                   resampling = warp.Resampling.nearest, dst_nodata = imageprofile["nodata"])
+    return warped
+
+
+def test_warp_image_copies_aligned_grids_as_reproject():
+    likeprofile = make_profile(Affine(30, 0, 300000, 0, -30, 4000000), 40, 30)
+    image = np.arange(25 * 50, dtype = "int16").reshape(25, 50)
+    # shifted by whole pixels, partly out of the target grid on each side
+    for col, row in ((5, 3), (-7, -4), (0, 0), (35, 20)):
+        imageprofile = make_profile(Affine(30, 0, 300000 + 30 * col, 0, -30, 4000000 - 30 * row), 50, 25)
+        warped, desprofile = warp_image(image, imageprofile, likeprofile)
+        assert desprofile["dtype"] == "int16" and desprofile["nodata"] == -9999
+        np.testing.assert_array_equal(warped, reproject_image(image, imageprofile, likeprofile))
+
+
+def test_warp_image_reprojects_unaligned_grids():
+    likeprofile = make_profile(Affine(30, 0, 300000, 0, -30, 4000000), 40, 30)
+    image = np.arange(25 * 50, dtype = "int16").reshape(25, 50)
+    imageprofile = make_profile(Affine(30, 0, 300000 + 45, 0, -30, 4000000 - 15), 50, 25)
+    destination = np.zeros((30, 40), dtype = "int16")
+    warped, _ = warp_image(image, imageprofile, likeprofile, destination = destination)
+    assert warped is destination
+    np.testing.assert_array_equal(warped, reproject_image(image, imageprofile, likeprofile))